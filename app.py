@@ -1,181 +1,467 @@
 import streamlit as st
-from pymongo import MongoClient
-from datetime import datetime, timedelta
-import hashlib
-from bson.objectid import ObjectId
-
-# MongoDB connection setup
-def get_mongo_connection():
-    # Get connection string from Streamlit secrets
-    connection_string = st.secrets["mongo"]["connection_string"]
-    client = MongoClient(connection_string)
-    db = client.leave_tracker
-    return db
-
-# Initialize MongoDB collections
+import importlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from instrumentation import METRICS_FILE_INTERVAL, InstrumentedStorage, current_rerun, finish_rerun, metrics_file_writer, process_metrics, start_rerun
+from leave_calc import DAYS, LeaveIntervalIndex, calculate_leave_hours, format_date, get_week_hours
+from passwords import DEFAULT_SCRYPT_N, dummy_hash, hash_password, verify_password
+from startup import DEFAULT_READY_FILE, Warmup
+from storage_common import HISTORY_PAGE_SIZE, UsernameTakenError
+from workers import DEFAULT_WORKER_SETTINGS, WorkerPool, WorkerPoolBusyError
+
+def load_secrets():
+    return st.secrets.to_dict() if st.secrets.load_if_toml_exists() else {}
+
+# Storage backend selection. Defaults to MongoDB from the [mongo] secrets section;
+# a [storage] section (or the LEAVE_TRACKER_BACKEND / LEAVE_TRACKER_DB_PATH
+# environment variables) selects the local SQLite backend instead.
+def load_storage_config():
+    secrets = load_secrets()
+    config = {"backend": "mongo", **secrets.get("mongo", {}), **secrets.get("storage", {})}
+    if os.environ.get("LEAVE_TRACKER_BACKEND"):
+        config["backend"] = os.environ["LEAVE_TRACKER_BACKEND"]
+    if os.environ.get("LEAVE_TRACKER_DB_PATH"):
+        config["path"] = os.environ["LEAVE_TRACKER_DB_PATH"]
+    return config
+
+# One storage backend (and, for MongoDB, one pooled client) shared by every session in the
+# process, instrumented so each rerun's data-layer calls are counted and timed. storage
+# (and with it pymongo) is imported here, which the warm-up does off the first paint.
+@st.cache_resource(show_spinner=False)
+def get_storage():
+    from storage import create_storage
+
+    return InstrumentedStorage(create_storage(load_storage_config()))
+
+# Debug panel and metrics export come from the [debug] secrets section or
+# LEAVE_TRACKER_DEBUG / LEAVE_TRACKER_METRICS_FILE
+def load_debug_config():
+    config = load_secrets().get("debug", {})
+    if os.environ.get("LEAVE_TRACKER_DEBUG"):
+        config["panel"] = os.environ["LEAVE_TRACKER_DEBUG"].lower() in ("1", "true", "yes")
+    if os.environ.get("LEAVE_TRACKER_METRICS_FILE"):
+        config["metrics_file"] = os.environ["LEAVE_TRACKER_METRICS_FILE"]
+    return config
+
+def get_pool_stats():
+    return get_storage().pool_stats()
+
+# Worker pool size from the [workers] secrets section
+def load_worker_config():
+    return {**DEFAULT_WORKER_SETTINGS, **load_secrets().get("workers", {})}
+
+# One bounded pool per server process for password hashing
+@st.cache_resource(show_spinner=False)
+def get_worker_pool():
+    config = load_worker_config()
+    return WorkerPool(int(config["max_workers"]), int(config["max_pending"]), float(config["queue_timeout"]))
+
+# A separate pool for background jobs, so long deletes never hold up logins
+@st.cache_resource(show_spinner=False)
+def get_job_pool():
+    config = load_worker_config()
+    return WorkerPool(
+        int(config["max_jobs"]), int(config["max_pending_jobs"]), float(config["queue_timeout"]), "leave-job"
+    )
+
+# scrypt cost for new password hashes, from [passwords] scrypt_n in the secrets
+def get_scrypt_n():
+    return int(load_secrets().get("passwords", {}).get("scrypt_n", DEFAULT_SCRYPT_N))
+
+def get_worker_stats():
+    return get_worker_pool().stats()
+
+def get_job_stats():
+    return get_job_pool().stats()
+
+# Bring the schema up to date once per server process; reruns hit the cached result
+@st.cache_resource(show_spinner=False)
+def bootstrap_db():
+    return get_storage().bootstrap()
+
+# Initialize the database
 def init_db():
     try:
-        db = get_mongo_connection()
-        # Check if collections exist, if not create them
-        if "users" not in db.list_collection_names():
-            db.create_collection("users")
-        if "leaves" not in db.list_collection_names():
-            db.create_collection("leaves")
-        if "settings" not in db.list_collection_names():
-            db.create_collection("settings")
+        bootstrap_db()
         return True
     except Exception as e:
         st.error(f"Database initialization error: {e}")
         return False
 
-# Helper functions for MongoDB operations
+# Modules only used after login. They are imported where they are used, which
+# keeps them (and NumPy) out of the login page's first run.
+PAGE_MODULES = ("leave_io", "planner", "reports")
+
+def import_page_modules():
+    for module in PAGE_MODULES:
+        importlib.import_module(module)
+
+# Once per server process, in the background: create the database client (SRV
+# lookup and first connection), bootstrap the schema, import the page modules
+# and prepare the hash checked for unknown usernames, then write the readiness
+# file (LEAVE_TRACKER_READY_FILE) that healthcheck.py --ready looks for
+@st.cache_resource(show_spinner=False)
+def get_warmup():
+    return Warmup([
+        ("storage", lambda: get_storage().ping()),
+        ("schema", bootstrap_db),
+        ("page_modules", import_page_modules),
+        ("password_hashing", lambda: dummy_hash(get_scrypt_n())),
+    ], os.environ.get("LEAVE_TRACKER_READY_FILE", DEFAULT_READY_FILE))
+
+# Read-through cache settings for per-user data
+CACHE_TTL_SECONDS = 60
+CACHE_MAX_ENTRIES = 32
+
+# Per-session read-through cache keyed by (user_id, kind), with a TTL and an LRU bound
+class SessionCache:
+    def __init__(self, ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get_or_load(self, user_id, kind, loader):
+        key = (str(user_id), kind)
+        entry = self._entries.get(key)
+        now = time.monotonic()
+        if entry is not None and entry[0] > now:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        value = loader()
+        self._entries[key] = (now + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return value
+
+    # Kinds may be tuples such as ("history", year, limit); they are matched on their first element.
+    # No kinds given drops every entry for the user.
+    def invalidate(self, user_id, *kinds):
+        for key in list(self._entries):
+            kind = key[1][0] if isinstance(key[1], tuple) else key[1]
+            if key[0] == str(user_id) and (not kinds or kind in kinds):
+                del self._entries[key]
+
+    def patch(self, user_id, kind, changes):
+        # Update a cached document in place after a write that returned its new values
+        entry = self._entries.get((str(user_id), kind))
+        if entry is not None:
+            entry[1].update(changes)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+# Per-user and team-wide counters bumped by every leave write in this process;
+# cached reports are keyed on them so a write invalidates the affected reports
+class DataVersions:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+
+    def get(self, key):
+        with self._lock:
+            return self._versions.get(key, 0)
+
+    def bump(self, user_id):
+        with self._lock:
+            for key in (str(user_id), "team"):
+                self._versions[key] = self._versions.get(key, 0) + 1
+
+@st.cache_resource(show_spinner=False)
+def get_data_versions():
+    return DataVersions()
+
+def get_session_cache():
+    if '_data_cache' not in st.session_state:
+        st.session_state._data_cache = SessionCache()
+    return st.session_state._data_cache
+
+def invalidate_user_cache(user_id, *kinds):
+    get_session_cache().invalidate(user_id, *kinds)
+
+# Helper functions for storage operations
 def create_user(username, password):
-    hashed_password = hashlib.sha256(password.encode('utf-8')).hexdigest()
-    db = get_mongo_connection()
-    
-    # Check if username already exists
-    if db.users.find_one({"username": username}):
-        st.error("Username already exists. Please choose a different username.")
-        return False
-    
     try:
-        # Insert new user
-        user_id = db.users.insert_one({
-            "username": username,
-            "password": hashed_password
-        }).inserted_id
-        
-        # Create default settings for the user
-        db.settings.insert_one({
-            "user_id": str(user_id),
-            "mon_hours": 7.5,
-            "tue_hours": 0,
-            "wed_hours": 10.5,
-            "thu_hours": 11.5,
-            "fri_hours": 8.5,
-            "sat_hours": 0,
-            "sun_hours": 0,
-            "leave_balance": 307.5  # Updated default leave balance
-        })
-        
+        hashed_password = get_worker_pool().run(hash_password, password, get_scrypt_n())
+        # Insert new user along with their default settings
+        get_storage().create_user(username, hashed_password)
         return True
+    except UsernameTakenError:
+        st.error("Username already exists. Please choose a different username.")
+        return False
     except Exception as e:
         st.error(f"Error creating user: {e}")
         return False
 
+# Looks the user up by name and checks the password on the worker pool. A legacy
+# sha256 hash, or one made with an older scrypt cost, is replaced in the
+# background after a successful login; the login does not wait for it.
+def authenticate_user(username, password):
+    storage, pool, scrypt_n = get_storage(), get_worker_pool(), get_scrypt_n()
+    credentials = storage.find_credentials(username)
+    stored_hash = credentials[1] if credentials else None
+    matches, needs_rehash = pool.run(verify_password, password, stored_hash, scrypt_n)
+    if not matches:
+        return None
+    if needs_rehash:
+        try:
+            pool.submit(rehash_password, storage, credentials[0], password, stored_hash, scrypt_n, wait=False)
+        except WorkerPoolBusyError:
+            pass  # Retried on the next login
+    return credentials[0]
+
+def rehash_password(storage, user_id, password, old_hash, scrypt_n):
+    return storage.set_password_hash(user_id, old_hash, hash_password(password, scrypt_n))
+
 def get_user_settings(user_id):
-    db = get_mongo_connection()
-    settings = db.settings.find_one({"user_id": str(user_id)})
-    
-    if not settings:
-        # Create default settings if not found
-        settings = {
-            "user_id": str(user_id),
-            "mon_hours": 7.5,
-            "tue_hours": 0,
-            "wed_hours": 10.5,
-            "thu_hours": 11.5,
-            "fri_hours": 8.5,
-            "sat_hours": 0,
-            "sun_hours": 0,
-            "leave_balance": 307.5  # Updated default leave balance
-        }
-        db.settings.insert_one(settings)
-    
-    return settings
+    return get_session_cache().get_or_load(user_id, "settings", lambda: get_storage().get_settings(user_id))
+
+# Applies a partial settings dict, e.g. {"mon_hours": 8.0, "leave_balance": 300.0}, in one write
+def update_user_settings(user_id, updates):
+    get_storage().update_settings(user_id, updates)
+    invalidate_user_cache(user_id, "settings")
+    # A balance change is a ledger event, which the cached reports read
+    if "leave_balance" in updates:
+        get_data_versions().bump(user_id)
 
-def update_user_settings(user_id, day, hours):
-    db = get_mongo_connection()
-    db.settings.update_one(
-        {"user_id": str(user_id)},
-        {"$set": {f"{day}_hours": hours}}
+# One page of leave history sorted by start date (earliest first); returns (leaves, has_more)
+def get_leave_history(user_id, year, limit):
+    return get_session_cache().get_or_load(
+        user_id, ("leaves", "page", year, limit),
+        lambda: get_storage().list_leaves_page(user_id, year=year, limit=limit)
     )
 
-def update_leave_balance(user_id, new_balance):
-    db = get_mongo_connection()
-    db.settings.update_one(
-        {"user_id": str(user_id)},
-        {"$set": {"leave_balance": new_balance}}
+def get_leave_years(user_id):
+    return get_session_cache().get_or_load(user_id, ("leaves", "years"), lambda: get_storage().leave_years(user_id))
+
+def get_leave_totals(user_id, year):
+    return get_session_cache().get_or_load(
+        user_id, ("leaves", "totals", year),
+        lambda: get_storage().leave_totals(user_id, year)
     )
 
-def parse_date(date_str):
-    return datetime.strptime(date_str, '%Y-%m-%d')
+# Closed years moved to the archive; their leaves are read-only
+def get_archived_years(user_id):
+    return get_session_cache().get_or_load(user_id, ("leaves", "archived_years"), lambda: get_storage().archived_years())
 
-def format_date(date_obj):
-    return date_obj.strftime('%Y-%m-%d')
+# Atomic leave booking. Returns the new balance, or None if the balance does not cover the hours.
+def book_leave(user_id, start_date, end_date, hours):
+    new_balance = get_storage().book_leave(user_id, start_date, end_date, hours)
+    if new_balance is not None:
+        apply_new_balance(user_id, new_balance)
+    return new_balance
 
-def calculate_leave_hours(start_date, end_date, user_id):
-    settings = get_user_settings(user_id)
-    total_hours = 0
-    current_date = parse_date(start_date)
-    end_date = parse_date(end_date)
-    
-    while current_date <= end_date:
-        day_of_week = current_date.strftime('%a').lower()
-        total_hours += settings[f'{day_of_week}_hours']
-        current_date += timedelta(days=1)
-    
-    return total_hours
+# Books a validated batch of leaves with one balance deduction. Returns the new balance, or None if it does not cover them.
+def import_leaves(user_id, leaves):
+    new_balance = get_storage().import_leaves(user_id, leaves)
+    if new_balance is not None:
+        apply_new_balance(user_id, new_balance)
+    return new_balance
 
-def check_overlap(user_id, new_start_date, new_end_date):
-    db = get_mongo_connection()
-    leaves = list(db.leaves.find({"user_id": str(user_id)}))
-    
-    new_start = parse_date(new_start_date)
-    new_end = parse_date(new_end_date)
-    
-    for leave in leaves:
-        existing_start = parse_date(leave['start_date'])
-        existing_end = parse_date(leave['end_date'])
-        if (new_start <= existing_end) and (new_end >= existing_start):
-            return True
-    
-    return False
+# The user's whole history as a CSV or iCalendar file. Leaves are streamed from
+# storage in batches and encoded as they arrive, so only the finished file is held.
+def export_leaves(user_id, file_format):
+    from leave_io import export_csv, export_ics
+
+    leaves = get_storage().iter_leaves(user_id)
+    chunks = export_ics(leaves) if file_format == "iCalendar" else export_csv(leaves)
+    return b"".join(chunk.encode("utf-8") for chunk in chunks)
+
+# Deletes one leave and refunds its hours. Returns the new balance, or None if the leave no longer exists.
+def cancel_leave(user_id, leave_id):
+    new_balance = get_storage().cancel_leave(user_id, leave_id)
+    if new_balance is not None:
+        apply_new_balance(user_id, new_balance)
+    return new_balance
+
+# Deletes the selected leaves and refunds their hours in one atomic operation. Returns the new balance.
+def cancel_leaves(user_id, leave_ids):
+    new_balance = get_storage().cancel_leaves(user_id, leave_ids)
+    apply_new_balance(user_id, new_balance)
+    return new_balance
+
+# Long-running account operations run on the job pool, one per session at a
+# time. The page polls the job's progress and applies its outcome on the rerun
+# after it finishes.
+JOB_POLL_SECONDS = 0.5
+JOB_LABELS = {
+    "delete_all": "Deleting leave history",
+    "delete_account": "Deleting account",
+}
+
+# Deletes all of a user's leaves in batches and refunds their hours. Returns the new balance.
+def delete_all_leaves_task(job, storage, user_id):
+    return storage.cancel_all_leaves_in_batches(user_id, progress=job.report)
+
+def delete_account_task(job, storage, user_id):
+    storage.delete_user_in_batches(user_id, progress=job.report)
+
+def start_background_job(name, task, user_id):
+    # A full job pool turns the request down at once rather than holding the script thread
+    st.session_state.background_job = get_job_pool().start_job(name, task, get_storage(), user_id, wait=False)
+
+def finish_background_job(user_id, job):
+    del st.session_state.background_job
+    # Even a failed job may have deleted some batches
+    invalidate_user_cache(user_id)
+    get_data_versions().bump(user_id)
+    if job.error is not None:
+        st.error(f"{JOB_LABELS[job.name]} failed: {job.error}")
+    elif job.name == "delete_all":
+        st.success("✅ All leave history deleted and hours refunded to your balance.")
+    elif job.name == "delete_account":
+        st.session_state.user_id = None
+        st.success("✅ Account deleted successfully!")
+
+# Reruns only itself while the job runs, then the whole page once it is done
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def render_job_progress(job):
+    if job.done:
+        st.rerun()
+    st.progress(job.progress, text=f"{JOB_LABELS[job.name]}… {job.message} leaves")
+
+def render_background_job():
+    job = st.session_state.get('background_job')
+    if job is None:
+        return
+    if job.done:
+        finish_background_job(st.session_state.user_id, job)
+    else:
+        render_job_progress(job)
+
+# Keep the cached settings in step with a balance returned by a write, and drop the cached leaves and reports
+def apply_new_balance(user_id, new_balance):
+    cache = get_session_cache()
+    cache.patch(user_id, "settings", {"leave_balance": new_balance})
+    cache.invalidate(user_id, "leaves")
+    get_data_versions().bump(user_id)
+
+# Returns the leaves that overlap the new range (empty list if none)
+def check_overlap(user_id, new_start_date, new_end_date, limit=1):
+    return get_storage().find_overlaps(user_id, new_start_date, new_end_date, limit=limit)
+
+def build_leave_index(user_id):
+    return LeaveIntervalIndex(get_storage().list_leaves(user_id))
+
+# Validates an uploaded import file against the user's leave. The result is kept
+# in the session for as long as the same file stays in the uploader and the
+# user's leave and working hours are unchanged, so the leave index is only
+# built for a new upload.
+# Returns (leaves to import, [(line, message)] for rejected rows).
+def validate_uploaded_import(user_id, uploaded_file, user_settings):
+    from leave_io import read_import_ranges, validate_import
+
+    # Hours come from the weekly pattern, which a settings write can change without bumping the data version
+    key = (user_id, uploaded_file.file_id, get_data_versions().get(str(user_id)), get_week_hours(user_settings))
+    cached = st.session_state.get('import_validation')
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    ranges = read_import_ranges(uploaded_file.name, uploaded_file.getvalue().decode("utf-8-sig"))
+    result = validate_import(ranges, user_settings, build_leave_index(user_id), get_archived_years(user_id))
+    st.session_state.import_validation = (key, result)
+    return result
+
+# Marks the end of a UI section so its render time shows up in the rerun metrics
+def checkpoint(section):
+    rerun = current_rerun()
+    if rerun is not None:
+        rerun.checkpoint(section)
+
+def prometheus_text():
+    gauges = {f"pool_{name}": value for name, value in get_pool_stats().items()}
+    gauges.update({f"workers_{name}": value for name, value in get_worker_stats().items()})
+    gauges.update({f"jobs_{name}": value for name, value in get_job_stats().items()})
+    gauges["warmup_ready"] = int(get_warmup().ready)
+    return process_metrics.render_prometheus(gauges)
+
+def render_debug_panel(rerun):
+    with st.sidebar.expander("🛠️ Debug: this rerun", expanded=True):
+        summary = rerun.summary()
+        st.write(f"**Data-layer calls:** {summary['db_calls']} ({summary['db_ms']:.1f} ms, {summary['documents']} documents)")
+        st.write(f"**Rerun time so far:** {summary['total_ms']:.1f} ms")
+        st.dataframe(
+            [{"operation": name, **stats} for name, stats in summary["operations"].items()],
+            hide_index=True
+        )
+        st.dataframe(
+            [{"section": name, "ms": ms} for name, ms in summary["sections"].items()],
+            hide_index=True
+        )
+        st.write("**Session cache:**", get_session_cache().stats())
+        st.write("**Connection pool:**", get_pool_stats())
+        warmup = get_warmup()
+        st.write("**Warm-up:**", {"ready": warmup.ready, "error": warmup.error, "steps_ms": warmup.timings})
+        st.code(prometheus_text(), language="text")
+
+# Custom CSS for styling, injected at the top of every run
+APP_CSS = """
+<style>
+.stButton button {
+    background-color: #4CAF50;
+    color: white;
+    border-radius: 5px;
+    padding: 10px 20px;
+    font-size: 16px;
+}
+.stButton button:hover {
+    background-color: #45a049;
+}
+.stHeader {
+    color: #2E86C1;
+}
+.stSubheader {
+    color: #1A5276;
+}
+.stWarning {
+    background-color: #F9E79F;
+    padding: 10px;
+    border-radius: 5px;
+}
+.stSuccess {
+    background-color: #D5F5E3;
+    padding: 10px;
+    border-radius: 5px;
+}
+</style>
+"""
 
 # Streamlit App
 def main():
-    # Custom CSS for styling
-    st.markdown(
-        """
-        <style>
-        .stButton button {
-            background-color: #4CAF50;
-            color: white;
-            border-radius: 5px;
-            padding: 10px 20px;
-            font-size: 16px;
-        }
-        .stButton button:hover {
-            background-color: #45a049;
-        }
-        .stHeader {
-            color: #2E86C1;
-        }
-        .stSubheader {
-            color: #1A5276;
-        }
-        .stWarning {
-            background-color: #F9E79F;
-            padding: 10px;
-            border-radius: 5px;
-        }
-        .stSuccess {
-            background-color: #D5F5E3;
-            padding: 10px;
-            border-radius: 5px;
-        }
-        </style>
-        """,
-        unsafe_allow_html=True
-    )
+    rerun = start_rerun()
+    debug_config = load_debug_config()
+    try:
+        render_app()
+        if debug_config.get("panel"):
+            render_debug_panel(rerun)
+    finally:
+        finish_rerun(rerun, user_id=st.session_state.get("user_id"))
+        if debug_config.get("metrics_file"):
+            metrics_file_writer.write(
+                debug_config["metrics_file"],
+                prometheus_text,
+                float(debug_config.get("metrics_interval", METRICS_FILE_INTERVAL))
+            )
+
+def render_app():
+    # Starts the process warm-up on the first run; later runs return at once
+    get_warmup().start()
+    st.markdown(APP_CSS, unsafe_allow_html=True)
 
     st.title("📅 Annual Leave Tracker")
 
     # Initialize session state
     if 'user_id' not in st.session_state:
         st.session_state.user_id = None
-    if 'delete_leave_id' not in st.session_state:
-        st.session_state.delete_leave_id = None
+    if 'leaves_to_delete' not in st.session_state:
+        st.session_state.leaves_to_delete = []
     if 'show_signup' not in st.session_state:
         st.session_state.show_signup = False
     if 'show_delete_confirmation' not in st.session_state:
@@ -188,11 +474,14 @@ def main():
         st.session_state.show_update_balance_confirmation = False
     if 'new_balance' not in st.session_state:
         st.session_state.new_balance = None
+    if 'pending_settings_update' not in st.session_state:
+        st.session_state.pending_settings_update = {}
 
-    # Initialize database
-    init_db()
+    # Progress or outcome of this session's background job, if any
+    render_background_job()
 
-    # Login and Sign-Up Section
+    # Login and Sign-Up Section. The form is shown before the database is
+    # initialized, which only its buttons need.
     if not st.session_state.user_id:
         st.header("🔐 Login / Sign Up")
         
@@ -203,7 +492,7 @@ def main():
             new_password = st.text_input("Choose a Password", type="password")
             confirm_password = st.text_input("Confirm Password", type="password")
             
-            if st.button("Create Account"):
+            if st.button("Create Account") and init_db():
                 if new_password == confirm_password:
                     if create_user(new_username, new_password):
                         st.success("✅ Account created successfully! Please log in.")
@@ -219,30 +508,56 @@ def main():
             username = st.text_input("Username")
             password = st.text_input("Password", type="password")
             
-            if st.button("Login"):
-                hashed_password = hashlib.sha256(password.encode('utf-8')).hexdigest()
-                db = get_mongo_connection()
-                user = db.users.find_one({"username": username, "password": hashed_password})
-                
-                if user:
-                    st.session_state.user_id = str(user['_id'])
-                    st.rerun()
+            if st.button("Login") and init_db():
+                try:
+                    user_id = authenticate_user(username, password)
+                except WorkerPoolBusyError as e:
+                    st.error(str(e))
                 else:
-                    st.error("Invalid username or password")
+                    if user_id:
+                        st.session_state.user_id = user_id
+                        st.rerun()
+                    else:
+                        st.error("Invalid username or password")
             
             if st.button("Sign Up"):
                 st.session_state.show_signup = True
+        checkpoint("login")
         return
 
+    # Initialize database (no-op once the warm-up or an earlier run has done it)
+    init_db()
+    checkpoint("init_db")
+
     # Main Application
     user_id = st.session_state.user_id
-    db = get_mongo_connection()
     user_settings = get_user_settings(user_id)
 
+    # Page Navigation
+    page = st.sidebar.radio("Page", ["Tracker", "Planner", "Reports", "Team Calendar"], key="page")
+    if page == "Planner":
+        from planner import render_planner_page
+        render_planner_page(get_storage(), user_id, user_settings, book_leave, get_archived_years(user_id))
+        checkpoint("planner")
+        return
+    if page == "Reports":
+        from reports import render_reports_page
+        versions = get_data_versions()
+        render_reports_page(get_storage(), user_id, user_settings, versions.get(user_id), versions.get("team"))
+        checkpoint("reports")
+        return
+    if page == "Team Calendar":
+        from reports import render_team_calendar_page
+        render_team_calendar_page(get_storage(), get_data_versions().get("team"))
+        checkpoint("team_calendar")
+        return
+
     # Leave Balance Section
     st.subheader("⏳ Remaining Leave Balance")
     st.markdown(f"**Current Balance: {user_settings['leave_balance']} hours**")
 
+    checkpoint("balance")
+
     # Add Leave Section
     st.subheader("➕ Add Leave")
     with st.container():
@@ -262,12 +577,15 @@ def main():
             end_date_str = format_date(end_date)
             
             if not hours:
-                hours = calculate_leave_hours(start_date_str, end_date_str, user_id)
+                hours = calculate_leave_hours(start_date_str, end_date_str, user_settings)
             
             if float(hours) > user_settings['leave_balance']:
                 st.warning("⚠️ Warning: The requested hours exceed your remaining leave balance. Please adjust your request.")
-            elif check_overlap(user_id, start_date_str, end_date_str):
-                st.warning("⚠️ Overlap detected with existing leave requests.")
+            elif start_date.year in get_archived_years(user_id):
+                st.warning(f"⚠️ {start_date.year} is closed and archived. Leave can no longer be added to it.")
+            elif overlapping := check_overlap(user_id, start_date_str, end_date_str):
+                conflict = overlapping[0]
+                st.warning(f"⚠️ Overlap detected with existing leave from {conflict['start_date']} to {conflict['end_date']}.")
                 
                 # Store the leave request details in session state
                 st.session_state.pending_leave_request = {
@@ -278,23 +596,11 @@ def main():
                 st.session_state.show_overlap_confirmation = True
             else:
                 # No overlap, proceed with adding the leave request
-                requested_on = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                db.leaves.insert_one({
-                    "user_id": str(user_id),
-                    "start_date": start_date_str,
-                    "end_date": end_date_str,
-                    "hours": hours,
-                    "requested_on": requested_on
-                })
-                
-                # Update leave balance
-                db.settings.update_one(
-                    {"user_id": str(user_id)},
-                    {"$set": {"leave_balance": user_settings['leave_balance'] - hours}}
-                )
-                
-                st.success("✅ Leave added successfully!")
-                st.rerun()
+                if book_leave(user_id, start_date_str, end_date_str, hours) is None:
+                    st.warning("⚠️ Warning: The requested hours exceed your remaining leave balance. Please adjust your request.")
+                else:
+                    st.success("✅ Leave added successfully!")
+                    st.rerun()
 
     # Overlap Confirmation Dialog
     if st.session_state.get('show_overlap_confirmation'):
@@ -304,29 +610,22 @@ def main():
             if st.button("Proceed", key="proceed_overlap"):
                 # Retrieve the pending leave request from session state
                 pending_request = st.session_state.pending_leave_request
-                requested_on = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                
-                # Add the leave request to the database
-                db.leaves.insert_one({
-                    "user_id": str(user_id),
-                    "start_date": pending_request["start_date"],
-                    "end_date": pending_request["end_date"],
-                    "hours": pending_request["hours"],
-                    "requested_on": requested_on
-                })
-                
-                # Update leave balance
-                db.settings.update_one(
-                    {"user_id": str(user_id)},
-                    {"$set": {"leave_balance": user_settings['leave_balance'] - pending_request["hours"]}}
+                new_balance = book_leave(
+                    user_id,
+                    pending_request["start_date"],
+                    pending_request["end_date"],
+                    pending_request["hours"]
                 )
                 
                 # Clear session state
                 del st.session_state.pending_leave_request
                 del st.session_state.show_overlap_confirmation
                 
-                st.success("✅ Leave added successfully!")
-                st.rerun()
+                if new_balance is None:
+                    st.warning("⚠️ Warning: The requested hours exceed your remaining leave balance. Please adjust your request.")
+                else:
+                    st.success("✅ Leave added successfully!")
+                    st.rerun()
         
         with col_no:
             if st.button("Cancel", key="cancel_overlap"):
@@ -336,83 +635,204 @@ def main():
                 st.info("❌ Leave request canceled.")
                 st.rerun()
 
+    checkpoint("add_leave")
+
     # View Leave History Section
     st.subheader("📋 Leave History")
-    leaves = list(db.leaves.find({"user_id": str(user_id)}))
+    years = get_leave_years(user_id)
     
-    if not leaves:
+    if not years:
         st.info("No leave history found.")
     else:
-        # Sort leaves by start date (earliest first - ascending order)
-        leaves.sort(key=lambda x: parse_date(x['start_date']), reverse=False)
+        # Default to the current year when it has leave, otherwise the most recent year
+        default_year = date.today().year if date.today().year in years else years[0]
+        year = st.selectbox("Year", years, index=years.index(default_year), key="history_year")
+        if st.session_state.get('history_limit_year') != year:
+            st.session_state.history_limit_year = year
+            st.session_state.history_limit = HISTORY_PAGE_SIZE
         
-        for leave in leaves:
-            with st.container():
-                col1, col2, col3 = st.columns([2, 2, 1])
-                with col1:
-                    st.write(f"**From:** {leave['start_date']}")
-                    st.write(f"**To:** {leave['end_date']}")
-                with col2:
-                    st.write(f"**Hours:** {leave['hours']}")
-                    st.write(f"**Requested on:** {leave['requested_on']}")
-                with col3:
-                    if st.button("Delete", key=f"delete_{leave['_id']}"):
-                        # Store the leave ID and show confirmation dialog
-                        st.session_state.delete_leave_id = str(leave['_id'])
-                        st.session_state.show_delete_confirmation = True
-                st.divider()
+        totals = get_leave_totals(user_id, year)
+        st.markdown(f"**Hours used in {year}: {totals['hours']} hours across {totals['count']} leave requests**")
+        if year in get_archived_years(user_id):
+            st.caption(
+                f"🗄️ {year} is closed and archived, so its archived leave can no longer be deleted. "
+                "Leave running into the next year is still active."
+            )
+        
+        leaves, has_more = get_leave_history(user_id, year, st.session_state.history_limit)
+        
+        # One grid for the whole page: sorting, search and multi-row selection
+        # happen client-side, so the widget count stays flat as history grows
+        selection = st.dataframe(
+            [
+                {
+                    "From": leave['start_date'],
+                    "To": leave['end_date'],
+                    "Hours": float(leave['hours']),
+                    "Requested on": leave['requested_on'],
+                    **({"Archived": leave['archived']} if 'archived' in leave else {})
+                }
+                for leave in leaves
+            ],
+            hide_index=True,
+            use_container_width=True,
+            on_select="rerun",
+            selection_mode="multi-row",
+            key=f"history_table_{year}"
+        )
+        selected_leaves = [leaves[row] for row in selection["selection"]["rows"]]
+        
+        col_delete, col_more = st.columns(2)
+        with col_delete:
+            # Archived rows are read-only; the active rows of an archived year are not
+            archived = any(leave.get('archived') for leave in selected_leaves)
+            if st.button("Delete Selected", key="delete_selected", disabled=archived or not selected_leaves):
+                # Store the selected leaves and show confirmation dialog
+                st.session_state.leaves_to_delete = [
+                    {
+                        "_id": str(leave['_id']),
+                        "start_date": leave['start_date'],
+                        "end_date": leave['end_date'],
+                        "hours": float(leave['hours'])
+                    }
+                    for leave in selected_leaves
+                ]
+                st.session_state.show_delete_confirmation = True
+        with col_more:
+            if has_more and st.button("Load more", key="history_load_more"):
+                st.session_state.history_limit += HISTORY_PAGE_SIZE
+                st.rerun()
     
     # Delete Confirmation Dialog
-    if st.session_state.get('show_delete_confirmation') and st.session_state.delete_leave_id:
-        leave_to_delete = db.leaves.find_one({"_id": ObjectId(st.session_state.delete_leave_id)})
+    if st.session_state.get('show_delete_confirmation') and st.session_state.leaves_to_delete:
+        leaves_to_delete = st.session_state.leaves_to_delete
         
-        if leave_to_delete:
-            st.warning(f"⚠️ Are you sure you want to delete the leave from {leave_to_delete['start_date']} to {leave_to_delete['end_date']}?")
-            col_yes, col_no = st.columns(2)
-            
-            with col_yes:
-                if st.button("Yes, Delete", key="confirm_delete"):
-                    # Refund the hours to the leave balance
-                    db.settings.update_one(
-                        {"user_id": str(user_id)},
-                        {"$inc": {"leave_balance": leave_to_delete['hours']}}
-                    )
-                    
-                    # Delete the leave record
-                    db.leaves.delete_one({"_id": ObjectId(st.session_state.delete_leave_id)})
-                    
-                    # Clear session state
-                    st.session_state.delete_leave_id = None
-                    st.session_state.show_delete_confirmation = False
-                    
+        if len(leaves_to_delete) == 1:
+            st.warning(f"⚠️ Are you sure you want to delete the leave from {leaves_to_delete[0]['start_date']} to {leaves_to_delete[0]['end_date']}?")
+        else:
+            total_hours = sum(leave['hours'] for leave in leaves_to_delete)
+            st.warning(f"⚠️ Are you sure you want to delete {len(leaves_to_delete)} leave requests ({total_hours} hours)?")
+        col_yes, col_no = st.columns(2)
+        
+        with col_yes:
+            if st.button("Yes, Delete", key="confirm_delete"):
+                # Delete the leave records and refund their hours to the leave balance
+                if len(leaves_to_delete) == 1:
+                    deleted = cancel_leave(user_id, leaves_to_delete[0]['_id']) is not None
+                else:
+                    cancel_leaves(user_id, [leave['_id'] for leave in leaves_to_delete])
+                    deleted = True
+                
+                # Clear session state
+                st.session_state.leaves_to_delete = []
+                st.session_state.show_delete_confirmation = False
+                
+                if deleted:
                     st.success("✅ Leave deleted and hours refunded to your balance.")
-                    st.rerun()
-            
-            with col_no:
-                if st.button("Cancel", key="cancel_delete"):
-                    # Clear session state
-                    st.session_state.delete_leave_id = None
-                    st.session_state.show_delete_confirmation = False
+                else:
+                    # Already deleted, e.g. from another tab, and refunded then
+                    st.info("ℹ️ That leave was already deleted, so nothing was refunded.")
+                st.rerun()
+        
+        with col_no:
+            if st.button("Cancel", key="cancel_delete"):
+                # Clear session state
+                st.session_state.leaves_to_delete = []
+                st.session_state.show_delete_confirmation = False
+                st.rerun()
+
+    checkpoint("history")
+
+    # Import & Export Section
+    st.subheader("📥 Import & Export")
+    uploaded_file = st.file_uploader(
+        "Import leave from a CSV (start_date, end_date) or iCalendar file",
+        type=["csv", "ics"],
+        key=f"import_file_{st.session_state.get('import_generation', 0)}"
+    )
+    if uploaded_file is not None:
+        try:
+            leaves_to_import, import_errors = validate_uploaded_import(user_id, uploaded_file, user_settings)
+        except (ValueError, UnicodeDecodeError) as e:
+            st.error(f"❌ Could not read {uploaded_file.name}: {e}")
+            leaves_to_import, import_errors = [], []
+
+        if import_errors:
+            st.warning(f"⚠️ {len(import_errors)} rows will be skipped:")
+            st.dataframe(
+                [{"Line": line, "Problem": message} for line, message in import_errors],
+                hide_index=True,
+                use_container_width=True
+            )
+        if leaves_to_import:
+            import_hours = sum(leave['hours'] for leave in leaves_to_import)
+            st.markdown(f"**{len(leaves_to_import)} leaves totalling {import_hours} hours are ready to import.**")
+            if st.button("Import Leaves", key="import_leaves"):
+                if import_leaves(user_id, leaves_to_import) is None:
+                    st.warning("⚠️ Warning: The imported hours exceed your remaining leave balance. Nothing was imported.")
+                else:
+                    # A new uploader key clears the imported file
+                    st.session_state.import_generation = st.session_state.get('import_generation', 0) + 1
+                    st.success(f"✅ Imported {len(leaves_to_import)} leaves.")
                     st.rerun()
 
+    col_format, col_export = st.columns(2)
+    with col_format:
+        export_format = st.selectbox("Export format", ["CSV", "iCalendar"], key="export_format")
+    with col_export:
+        # The file is only built on request, not on every rerun
+        if st.button("Prepare Export", key="prepare_export"):
+            extension, mime = ("ics", "text/calendar") if export_format == "iCalendar" else ("csv", "text/csv")
+            st.download_button(
+                f"Download {export_format}",
+                export_leaves(user_id, export_format),
+                file_name=f"leave_history.{extension}",
+                mime=mime,
+                key="download_export"
+            )
+
+    checkpoint("import_export")
+
     # Settings Section
     st.subheader("⚙️ Settings")
     
-    # Update Leave Balance Option
-    with st.expander("Update Leave Balance"):
-        st.write(f"Current leave balance: **{user_settings['leave_balance']} hours**")
-        new_balance = st.number_input("New Leave Balance (hours)", 
-                                     min_value=0.0, 
-                                     value=float(user_settings['leave_balance']), 
-                                     step=0.5)
-        
-        if st.button("Update Balance"):
-            if new_balance != user_settings['leave_balance']:
-                # Store new balance in session state and trigger confirmation
-                st.session_state.new_balance = new_balance
-                st.session_state.show_update_balance_confirmation = True
-            else:
-                st.info("No change in balance detected.")
+    # Leave Balance and Working Hours, submitted together as one write and one rerun
+    with st.expander("Leave Balance & Working Hours"):
+        with st.form("settings_form"):
+            st.write(f"Current leave balance: **{user_settings['leave_balance']} hours**")
+            new_balance = st.number_input("New Leave Balance (hours)", 
+                                         min_value=0.0, 
+                                         value=float(user_settings['leave_balance']), 
+                                         step=0.5)
+            
+            st.write("Set your working hours for each day of the week:")
+            day_names = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+            new_hours = {}
+            for day, day_name in zip(DAYS, day_names):
+                col1, col2 = st.columns([1, 3])
+                with col1:
+                    st.write(f"{day_name}:")
+                with col2:
+                    new_hours[day] = st.number_input(f"Hours for {day_name}", min_value=0.0, max_value=24.0, value=float(user_settings[f'{day}_hours']), step=0.5, key=f"hours_{day}")
+            
+            if st.form_submit_button("Save Settings"):
+                updates = {
+                    f"{day}_hours": hours
+                    for day, hours in new_hours.items()
+                    if hours != user_settings[f'{day}_hours']
+                }
+                if new_balance != user_settings['leave_balance']:
+                    # Balance changes need confirmation; hold the whole batch until then
+                    updates["leave_balance"] = new_balance
+                    st.session_state.new_balance = new_balance
+                    st.session_state.pending_settings_update = updates
+                    st.session_state.show_update_balance_confirmation = True
+                elif updates:
+                    update_user_settings(user_id, updates)
+                    st.success("✅ Working hours updated.")
+                    st.rerun()
+                else:
+                    st.info("No changes detected.")
     
     # Update Balance Confirmation Dialog
     if st.session_state.get('show_update_balance_confirmation') and st.session_state.new_balance is not None:
@@ -430,52 +850,39 @@ def main():
         col_yes, col_no = st.columns(2)
         with col_yes:
             if st.button("Yes, Update Balance", key="confirm_update_balance"):
-                # Update the leave balance
-                update_leave_balance(user_id, new_balance)
+                # Update the leave balance together with any working hours changes
+                update_user_settings(user_id, st.session_state.pending_settings_update)
                 
                 # Clear session state
                 st.session_state.new_balance = None
+                st.session_state.pending_settings_update = {}
                 st.session_state.show_update_balance_confirmation = False
                 
-                st.success("✅ Leave balance updated successfully!")
+                st.success("✅ Settings updated successfully!")
                 st.rerun()
         
         with col_no:
             if st.button("Cancel", key="cancel_update_balance"):
                 # Clear session state
                 st.session_state.new_balance = None
+                st.session_state.pending_settings_update = {}
                 st.session_state.show_update_balance_confirmation = False
                 st.info("❌ Balance update canceled.")
                 st.rerun()
-    
-    # Working Hours Settings
-    with st.expander("Working Hours Settings"):
-        st.write("Set your working hours for each day of the week:")
-        
-        days = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
-        day_names = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
-        
-        for day, day_name in zip(days, day_names):
-            col1, col2 = st.columns([1, 3])
-            with col1:
-                st.write(f"{day_name}:")
-            with col2:
-                new_hours = st.number_input(f"Hours for {day_name}", min_value=0.0, max_value=24.0, value=float(user_settings[f'{day}_hours']), step=0.5, key=f"hours_{day}")
-                if new_hours != user_settings[f'{day}_hours']:
-                    update_user_settings(user_id, day, new_hours)
-                    st.success(f"✅ {day_name} hours updated.")
-                    st.rerun()
+
+    checkpoint("settings")
 
     # Danger Zone Section
+    job_running = 'background_job' in st.session_state
     with st.expander("Danger Zone"):
         st.warning("⚠️ These actions are irreversible. Proceed with caution.")
         
         # Delete All Leave History
-        if st.button("Delete All Leave History", key="delete_all"):
+        if st.button("Delete All Leave History", key="delete_all", disabled=job_running):
             st.session_state.show_delete_all_confirmation = True
         
         # Delete Account
-        if st.button("Delete Account", key="delete_account"):
+        if st.button("Delete Account", key="delete_account", disabled=job_running):
             st.session_state.show_delete_account_confirmation = True
     
     # Delete All Leave History Confirmation Dialog
@@ -484,24 +891,16 @@ def main():
         col_yes, col_no = st.columns(2)
         
         with col_yes:
-            if st.button("Yes, Delete All", key="confirm_delete_all"):
-                # Get total hours from all leaves
-                total_hours = sum(leave['hours'] for leave in leaves)
-                
-                # Refund all hours to the leave balance
-                db.settings.update_one(
-                    {"user_id": str(user_id)},
-                    {"$set": {"leave_balance": user_settings['leave_balance'] + total_hours}}
-                )
-                
-                # Delete all leave records for this user
-                db.leaves.delete_many({"user_id": str(user_id)})
-                
-                # Clear session state
-                del st.session_state.show_delete_all_confirmation
-                
-                st.success("✅ All leave history deleted and hours refunded to your balance.")
-                st.rerun()
+            if st.button("Yes, Delete All", key="confirm_delete_all", disabled=job_running):
+                # Delete all leave records for this user and refund their hours in the background
+                try:
+                    start_background_job("delete_all", delete_all_leaves_task, user_id)
+                except WorkerPoolBusyError as e:
+                    st.error(str(e))
+                else:
+                    # Clear session state
+                    del st.session_state.show_delete_all_confirmation
+                    st.rerun()
         
         with col_no:
             if st.button("Cancel", key="cancel_delete_all"):
@@ -516,18 +915,16 @@ def main():
         col_yes, col_no = st.columns(2)
         
         with col_yes:
-            if st.button("Yes, Delete My Account", key="confirm_delete_account"):
-                # Delete user, settings, and leave records
-                db.users.delete_one({"_id": ObjectId(user_id)})
-                db.settings.delete_many({"user_id": str(user_id)})
-                db.leaves.delete_many({"user_id": str(user_id)})
-                
-                # Clear session state
-                del st.session_state.user_id
-                st.session_state.show_delete_account_confirmation = False
-                
-                st.success("✅ Account deleted successfully!")
-                st.rerun()
+            if st.button("Yes, Delete My Account", key="confirm_delete_account", disabled=job_running):
+                # Delete user, settings, and leave records in the background; the session logs out when it is done
+                try:
+                    start_background_job("delete_account", delete_account_task, user_id)
+                except WorkerPoolBusyError as e:
+                    st.error(str(e))
+                else:
+                    # Clear session state
+                    st.session_state.show_delete_account_confirmation = False
+                    st.rerun()
         
         with col_no:
             if st.button("Cancel", key="cancel_delete_account"):
@@ -540,6 +937,7 @@ def main():
     if st.button("🚪 Logout"):
         del st.session_state.user_id
         st.success("✅ Logged out successfully!")
+    checkpoint("danger_zone")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,54 @@
+# Moves a closed leave year out of the active partition into the archive and
+# writes one summary per user with their closing balance and carry-over. Users
+# whose balance ledger starts after the year are archived without them.
+#
+# Safe to re-run: users already archived for the year are skipped. Running
+# apps pick up a newly archived year the next time they load a user's years.
+#
+#   python archive.py --year 2024 --carry-over-limit 40 --connection-string "mongodb+srv://..."
+#   python archive.py --year 2024 --backend sqlite --path leave_tracker.db
+import argparse
+import os
+
+from storage import create_storage
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive a closed leave year and carry balances over.")
+    parser.add_argument("--year", type=int, required=True)
+    parser.add_argument(
+        "--carry-over-limit",
+        type=float,
+        help="hours a balance may carry into the next year; the excess is forfeited (default: no limit)"
+    )
+    parser.add_argument("--backend", choices=["mongo", "sqlite"], default="mongo")
+    parser.add_argument(
+        "--connection-string",
+        default=os.environ.get("MONGO_CONNECTION_STRING"),
+        help="MongoDB connection string (defaults to $MONGO_CONNECTION_STRING)"
+    )
+    parser.add_argument("--database", default="leave_tracker")
+    parser.add_argument("--path", default="leave_tracker.db", help="database file for the sqlite backend")
+    args = parser.parse_args()
+    if args.backend == "mongo" and not args.connection_string:
+        parser.error("a connection string is required")
+
+    storage = create_storage({
+        "backend": args.backend,
+        "connection_string": args.connection_string,
+        "database": args.database,
+        "path": args.path,
+    })
+    storage.bootstrap()
+    try:
+        archived = storage.archive_year(args.year, carry_over_limit=args.carry_over_limit)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"Done: archived {archived['leaves']} leaves of {args.year} for {archived['users']} users.")
+    if archived["unknown_balances"]:
+        print(
+            f"{archived['unknown_balances']} of them had no balance ledger yet at the end of {args.year}; "
+            "their closing balance is unknown and nothing was carried over or forfeited."
+        )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+# Load generator and benchmark for the leave workflows.
+#
+# Drives the same storage and calculation calls that main() makes (login,
+# settings, leave-hour calculation, overlap check, booking, history, reports,
+# team calendar, planner, balance ledger and delete-all) with synthetic users
+# against a local backend, then reports throughput and latency percentiles per
+# operation. Results are written as JSON so runs from different commits can be
+# compared:
+#
+#   python benchmark.py --users 20 --leaves 2000 --concurrency 8 --output before.json
+#   python benchmark.py --users 20 --leaves 2000 --concurrency 8 --compare before.json
+import argparse
+import json
+import platform
+import random
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from datetime import datetime, timedelta
+
+from leave_calc import calculate_leave_hours, format_date
+from passwords import hash_password, verify_password
+from planner import plan_leave
+from storage import create_storage
+
+PASSWORD = "benchmark-password"
+OPERATIONS = ["login", "get_settings", "calculate_leave_hours", "check_overlap", "book_and_cancel", "history", "reports", "team_calendar", "planner", "ledger", "delete_all"]
+
+# Every synthetic user shares one scrypt hash so seeding does not pay for a hash per user
+@lru_cache(maxsize=None)
+def password_hash():
+    return hash_password(PASSWORD)
+
+# Non-overlapping leaves walking back from the end of 2030, one to ten days long with gaps between them
+def generate_leaves(rng, count):
+    leaves = []
+    end = datetime(2030, 12, 31)
+    for _ in range(count):
+        end -= timedelta(days=rng.randint(1, 5))
+        start = end - timedelta(days=rng.randint(0, 9))
+        leaves.append((format_date(start), format_date(end)))
+        end = start - timedelta(days=1)
+    return leaves
+
+def seed_users(storage, user_count, leaves_per_user, rng):
+    # A per-run prefix keeps usernames unique when reusing a sqlite file
+    run_prefix = f"bench-{int(time.time())}"
+    users = []
+    for index in range(user_count):
+        username = f"{run_prefix}-user-{index}"
+        user_id = storage.create_user(username, password_hash())
+        storage.update_settings(user_id, {"leave_balance": 1e9})
+        leaves = generate_leaves(rng, leaves_per_user)
+        for start_date, end_date in leaves:
+            storage.book_leave(user_id, start_date, end_date, rng.choice([7.5, 15.0, 38.0]))
+        users.append({"username": username, "user_id": user_id, "leaves": leaves})
+    return users
+
+def random_range(rng, days=14):
+    start = datetime(2020, 1, 1) + timedelta(days=rng.randint(0, 365 * 10))
+    return format_date(start), format_date(start + timedelta(days=rng.randint(0, days)))
+
+# Builds the callable for one operation. It raises on unexpected results and may
+# return its own measured duration when part of the call is setup work.
+def make_operation(storage, name, users, rng):
+    def pick_user():
+        return rng.choice(users)
+
+    if name == "login":
+        def run():
+            user = pick_user()
+            user_id, stored_hash = storage.find_credentials(user["username"])
+            if user_id != user["user_id"] or not verify_password(PASSWORD, stored_hash)[0]:
+                raise RuntimeError("login failed")
+    elif name == "get_settings":
+        def run():
+            storage.get_settings(pick_user()["user_id"])
+    elif name == "calculate_leave_hours":
+        def run():
+            settings = storage.get_settings(pick_user()["user_id"])
+            calculate_leave_hours(*random_range(rng, days=365), settings)
+    elif name == "check_overlap":
+        def run():
+            storage.find_overlaps(pick_user()["user_id"], *random_range(rng))
+    elif name == "book_and_cancel":
+        def run():
+            user = pick_user()
+            start_date, end_date = random_range(rng, days=4)
+            storage.book_leave(user["user_id"], start_date, end_date, 7.5)
+            for leave in storage.find_overlaps(user["user_id"], start_date, end_date, limit=0):
+                if leave["start_date"] == start_date and leave["end_date"] == end_date:
+                    storage.cancel_leave(user["user_id"], leave["_id"])
+                    break
+    elif name == "history":
+        # What the history section loads: the year list, the year's totals and its first page
+        def run():
+            user_id = pick_user()["user_id"]
+            years = storage.leave_years(user_id)
+            year = rng.choice(years)
+            storage.leave_totals(user_id, year)
+            storage.list_leaves_page(user_id, year=year)
+    elif name == "reports":
+        # The uncached cost of the reports page: the user's monthly and yearly usage plus the team reports
+        def run():
+            user_id = pick_user()["user_id"]
+            year = rng.randint(2020, 2030)
+            storage.usage_by_month(user_id, year)
+            storage.usage_by_year(user_id)
+            storage.team_usage(year)
+            storage.team_hours_distribution(year)
+    elif name == "team_calendar":
+        # The team calendar page over its default 90-day window
+        def run():
+            start_date, end_date = random_range(rng, days=90)
+            days = storage.team_calendar(start_date, end_date)
+            storage.get_usernames(sorted({user_id for day in days for user_id in day["user_ids"]}))
+    elif name == "planner":
+        # A half-year planner window: the overlap read plus the vectorized search
+        def run():
+            user_id = pick_user()["user_id"]
+            settings = storage.get_settings(user_id)
+            start_date, end_date = random_range(rng, days=180)
+            plan_leave(start_date, end_date, 300.0, settings, storage.find_overlaps(user_id, start_date, end_date, limit=0))
+    elif name == "ledger":
+        # Current and historical balance from the nearest snapshot plus the events after it
+        def run():
+            user_id = pick_user()["user_id"]
+            storage.balance_as_of(user_id)
+            storage.balance_as_of(user_id, random_range(rng)[0])
+    elif name == "delete_all":
+        # Each call gets its own freshly seeded user so the work per call stays constant
+        counter = iter(range(10**9))
+
+        def run():
+            user_id = storage.create_user(f"bench-delete-{next(counter)}-{rng.random()}", password_hash())
+            storage.update_settings(user_id, {"leave_balance": 1e9})
+            for start_date, end_date in generate_leaves(rng, 50):
+                storage.book_leave(user_id, start_date, end_date, 7.5)
+            started = time.perf_counter()
+            storage.cancel_all_leaves_in_batches(user_id)
+            return time.perf_counter() - started
+    else:
+        raise ValueError(f"Unknown operation: {name}")
+    return run
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def run_operation(storage, name, users, iterations, concurrency, seed):
+    rng = random.Random(seed)
+    run = make_operation(storage, name, users, rng)
+
+    def timed_call(_):
+        started = time.perf_counter()
+        measured = run()
+        # Operations with setup work report their own timing
+        return measured if measured is not None else time.perf_counter() - started
+
+    wall_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = sorted(executor.map(timed_call, range(iterations)))
+    wall_seconds = time.perf_counter() - wall_started
+
+    return {
+        "calls": len(latencies),
+        "throughput_per_s": len(latencies) / wall_seconds if wall_seconds else 0.0,
+        "mean_ms": 1000 * sum(latencies) / len(latencies),
+        "p50_ms": 1000 * percentile(latencies, 0.50),
+        "p90_ms": 1000 * percentile(latencies, 0.90),
+        "p99_ms": 1000 * percentile(latencies, 0.99),
+        "max_ms": 1000 * latencies[-1],
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_report(results, baseline=None):
+    print(f"{'operation':<24}{'ops/s':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, stats in results["operations"].items():
+        line = (
+            f"{name:<24}{stats['throughput_per_s']:>10.1f}{stats['p50_ms']:>10.3f}"
+            f"{stats['p90_ms']:>10.3f}{stats['p99_ms']:>10.3f}{stats['max_ms']:>10.3f}"
+        )
+        previous = (baseline or {}).get("operations", {}).get(name)
+        if previous and previous["p50_ms"]:
+            change = 100 * (stats["p50_ms"] - previous["p50_ms"]) / previous["p50_ms"]
+            line += f"   p50 {change:+.1f}% vs {baseline.get('commit') or 'baseline'}"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the leave tracker workflows against a local backend.")
+    parser.add_argument("--backend", choices=["memory", "sqlite"], default="memory")
+    parser.add_argument("--path", default="benchmark.db", help="database file for the sqlite backend")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--leaves", type=int, default=1000, help="leaves seeded per user")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--iterations", type=int, default=500, help="calls per operation")
+    parser.add_argument("--operations", nargs="+", choices=OPERATIONS, default=OPERATIONS)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="previous JSON results to compare against")
+    args = parser.parse_args()
+
+    storage = create_storage({"backend": args.backend, "path": args.path})
+    storage.bootstrap()
+
+    seed_started = time.perf_counter()
+    users = seed_users(storage, args.users, args.leaves, random.Random(args.seed))
+    seed_seconds = time.perf_counter() - seed_started
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "parameters": {
+            "backend": args.backend,
+            "users": args.users,
+            "leaves_per_user": args.leaves,
+            "concurrency": args.concurrency,
+            "iterations": args.iterations,
+            "seed": args.seed,
+        },
+        "seed_seconds": seed_seconds,
+        "operations": {},
+    }
+    for offset, name in enumerate(args.operations):
+        results["operations"][name] = run_operation(
+            storage, name, users, args.iterations, args.concurrency, args.seed + offset
+        )
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+if __name__ == '__main__':
+    main()
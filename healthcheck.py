@@ -0,0 +1,96 @@
+# Liveness and readiness checks for a container orchestrator.
+#
+#   python healthcheck.py                   # live: the Streamlit server answers
+#   python healthcheck.py --ready           # ready: and its warm-up has finished
+#   python healthcheck.py --warm --ready    # opens one session first, so a fresh
+#                                           # instance warms up before any user arrives
+#
+# Exits 0 when healthy and 1 otherwise, printing the reason. The warm-up writes
+# the readiness file once the process has connected to and bootstrapped the
+# database; it starts with the first session in the process.
+import argparse
+import asyncio
+import os
+import sys
+import time
+import urllib.request
+
+from startup import DEFAULT_READY_FILE, read_ready_file
+
+def server_alive(url, timeout):
+    try:
+        with urllib.request.urlopen(f"{url}/_stcore/health", timeout=timeout) as response:
+            return response.status == 200
+    except OSError:
+        return False
+
+# Opens a session over Streamlit's websocket and asks for one script run, which
+# starts the warm-up in the server process
+def open_session(url, timeout):
+    from streamlit.proto.BackMsg_pb2 import BackMsg
+    from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+    from tornado.websocket import websocket_connect
+
+    async def rerun():
+        connection = await asyncio.wait_for(
+            websocket_connect(f"{url.replace('http', 'ws', 1)}/_stcore/stream", subprotocols=["streamlit"]),
+            timeout
+        )
+        try:
+            message = BackMsg()
+            message.rerun_script.query_string = ""
+            await connection.write_message(message.SerializeToString(), binary=True)
+            # Closing the session stops its script, so stay until the script has
+            # drawn its first element, which comes after the warm-up has started
+            while True:
+                reply = await asyncio.wait_for(connection.read_message(), timeout)
+                if reply is None:
+                    raise OSError("connection closed")
+                if ForwardMsg.FromString(reply).WhichOneof("type") in ("delta", "script_finished"):
+                    return
+        finally:
+            connection.close()
+
+    asyncio.run(rerun())
+
+def wait_until_ready(ready_file, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        record = read_ready_file(ready_file)
+        if record is not None or time.monotonic() >= deadline:
+            return record
+        time.sleep(0.2)
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the leave tracker is live and, optionally, warmed up.")
+    parser.add_argument("--url", default=os.environ.get("LEAVE_TRACKER_URL", "http://localhost:8501"))
+    parser.add_argument("--ready", action="store_true", help="also require the warm-up to have finished")
+    parser.add_argument("--warm", action="store_true", help="open a session first so the warm-up starts")
+    parser.add_argument(
+        "--ready-file",
+        default=os.environ.get("LEAVE_TRACKER_READY_FILE", DEFAULT_READY_FILE),
+        help="readiness file written by the warm-up (defaults to $LEAVE_TRACKER_READY_FILE)"
+    )
+    parser.add_argument("--timeout", type=float, default=5.0, help="seconds to wait for each step")
+    args = parser.parse_args()
+
+    if not server_alive(args.url, args.timeout):
+        print(f"not live: {args.url} did not answer")
+        sys.exit(1)
+    if args.warm and read_ready_file(args.ready_file) is None:
+        try:
+            open_session(args.url, args.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            print(f"not ready: could not open a session ({e or 'timed out'})")
+            sys.exit(1)
+    if args.ready:
+        record = wait_until_ready(args.ready_file, args.timeout if args.warm else 0)
+        if record is None:
+            print("not ready: warm-up has not finished")
+            sys.exit(1)
+        print(f"ready since {record['ready_at']} (pid {record['pid']})")
+    else:
+        print("live")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from types import GeneratorType
+
+logger = logging.getLogger("leave_tracker.metrics")
+
+# Metrics for the rerun running on the current script thread
+_current_rerun = ContextVar("current_rerun", default=None)
+
+def get_metrics_logger():
+    # Streamlit only configures its own loggers, so give ours a handler if nobody else has
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+# Documents in a call's result: the items of a list, the rows of a
+# (rows, has_more) page, or one for a single document or record tuple
+def count_documents(result):
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, tuple) and result and isinstance(result[0], list):
+        return len(result[0])
+    if isinstance(result, (dict, tuple)):
+        return 1
+    return 0
+
+# Call counts, latency and documents per data-layer operation plus time per
+# UI section, for a single Streamlit rerun
+class RerunMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.operations = {}
+        self.sections = {}
+        self._last_checkpoint = self.started
+        self.total_ms = None
+
+    def record_call(self, operation, elapsed_ms, documents):
+        stats = self.operations.setdefault(operation, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0, "documents": 0})
+        stats["calls"] += 1
+        stats["total_ms"] += elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+        stats["documents"] += documents
+
+    # Attributes the time since the previous checkpoint to the named UI section
+    def checkpoint(self, section):
+        now = time.perf_counter()
+        self.sections[section] = self.sections.get(section, 0.0) + (now - self._last_checkpoint) * 1000
+        self._last_checkpoint = now
+
+    def finish(self):
+        self.total_ms = (time.perf_counter() - self.started) * 1000
+
+    def summary(self):
+        return {
+            "total_ms": round(self.total_ms if self.total_ms is not None else (time.perf_counter() - self.started) * 1000, 3),
+            "db_calls": sum(stats["calls"] for stats in self.operations.values()),
+            "db_ms": round(sum(stats["total_ms"] for stats in self.operations.values()), 3),
+            "documents": sum(stats["documents"] for stats in self.operations.values()),
+            "operations": {
+                name: {**stats, "total_ms": round(stats["total_ms"], 3), "max_ms": round(stats["max_ms"], 3)}
+                for name, stats in self.operations.items()
+            },
+            "sections": {name: round(ms, 3) for name, ms in self.sections.items()},
+        }
+
+# Process-wide totals across every rerun, rendered in the Prometheus text format
+class ProcessMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reruns = 0
+        self.rerun_seconds = 0.0
+        self.operations = {}
+        self.sections = {}
+
+    def add_rerun(self, rerun):
+        with self._lock:
+            self.reruns += 1
+            self.rerun_seconds += (rerun.total_ms or 0.0) / 1000
+            for operation, stats in rerun.operations.items():
+                totals = self.operations.setdefault(operation, {"calls": 0, "seconds": 0.0, "documents": 0})
+                totals["calls"] += stats["calls"]
+                totals["seconds"] += stats["total_ms"] / 1000
+                totals["documents"] += stats["documents"]
+            for section, ms in rerun.sections.items():
+                self.sections[section] = self.sections.get(section, 0.0) + ms / 1000
+
+    def render_prometheus(self, extra_gauges=None):
+        with self._lock:
+            lines = [
+                "# HELP leave_tracker_reruns_total Streamlit reruns completed.",
+                "# TYPE leave_tracker_reruns_total counter",
+                f"leave_tracker_reruns_total {self.reruns}",
+                "# HELP leave_tracker_rerun_seconds_total Time spent in reruns.",
+                "# TYPE leave_tracker_rerun_seconds_total counter",
+                f"leave_tracker_rerun_seconds_total {self.rerun_seconds:.6f}",
+                "# HELP leave_tracker_db_calls_total Data-layer calls by operation.",
+                "# TYPE leave_tracker_db_calls_total counter",
+            ]
+            lines += [f'leave_tracker_db_calls_total{{operation="{name}"}} {stats["calls"]}' for name, stats in sorted(self.operations.items())]
+            lines += [
+                "# HELP leave_tracker_db_seconds_total Time spent in data-layer calls by operation.",
+                "# TYPE leave_tracker_db_seconds_total counter",
+            ]
+            lines += [f'leave_tracker_db_seconds_total{{operation="{name}"}} {stats["seconds"]:.6f}' for name, stats in sorted(self.operations.items())]
+            lines += [
+                "# HELP leave_tracker_db_documents_total Documents returned by data-layer calls by operation.",
+                "# TYPE leave_tracker_db_documents_total counter",
+            ]
+            lines += [f'leave_tracker_db_documents_total{{operation="{name}"}} {stats["documents"]}' for name, stats in sorted(self.operations.items())]
+            lines += [
+                "# HELP leave_tracker_section_seconds_total Time spent rendering each UI section.",
+                "# TYPE leave_tracker_section_seconds_total counter",
+            ]
+            lines += [f'leave_tracker_section_seconds_total{{section="{name}"}} {seconds:.6f}' for name, seconds in sorted(self.sections.items())]
+        for name, value in sorted((extra_gauges or {}).items()):
+            lines += [f"# TYPE leave_tracker_{name} gauge", f"leave_tracker_{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+process_metrics = ProcessMetrics()
+
+# Minimum seconds between two writes of the metrics file by one process
+METRICS_FILE_INTERVAL = 10.0
+
+# Writes the Prometheus text to a file for a node_exporter textfile collector, at
+# most once every interval seconds. Sessions rerun on parallel threads, so writes
+# are serialised, and each goes through its own temporary file in the same
+# directory before being moved into place.
+class MetricsFileWriter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_written = {}
+
+    # render is only called when the file is due. Returns whether it was written.
+    def write(self, path, render, interval=METRICS_FILE_INTERVAL):
+        with self._lock:
+            now = time.monotonic()
+            last_written = self._last_written.get(path)
+            if last_written is not None and now - last_written < interval:
+                return False
+            self._last_written[path] = now
+            directory, name = os.path.split(os.path.abspath(path))
+            temporary_path = None
+            try:
+                with tempfile.NamedTemporaryFile(
+                    "w", dir=directory, prefix=f".{name}.", suffix=".tmp", delete=False
+                ) as metrics_file:
+                    temporary_path = metrics_file.name
+                    metrics_file.write(render())
+                # Readable by the collector, which usually runs as another user
+                os.chmod(temporary_path, 0o644)
+                os.replace(temporary_path, path)
+            except OSError as e:
+                get_metrics_logger().warning(json.dumps({"event": "metrics_file_error", "path": path, "error": str(e)}))
+                if temporary_path is not None and os.path.exists(temporary_path):
+                    os.unlink(temporary_path)
+                return False
+            return True
+
+metrics_file_writer = MetricsFileWriter()
+
+def start_rerun():
+    rerun = RerunMetrics()
+    _current_rerun.set(rerun)
+    return rerun
+
+def current_rerun():
+    return _current_rerun.get()
+
+def finish_rerun(rerun, **fields):
+    rerun.finish()
+    _current_rerun.set(None)
+    process_metrics.add_rerun(rerun)
+    get_metrics_logger().info(json.dumps({"event": "rerun", **fields, **rerun.summary()}))
+
+@contextmanager
+def timed_call(operation):
+    started = time.perf_counter()
+    result = {"documents": 0, "streamed": False, "elapsed_ms": lambda: (time.perf_counter() - started) * 1000}
+    try:
+        yield result
+    finally:
+        rerun = current_rerun()
+        if rerun is not None and not result["streamed"]:
+            rerun.record_call(operation, result["elapsed_ms"](), result["documents"])
+
+# Passes a generator's items through, timing only the time spent producing them,
+# and records the call against the rerun it was made in once it is exhausted or closed
+def timed_iteration(operation, items, rerun, elapsed_ms=0.0):
+    documents = 0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                elapsed_ms += (time.perf_counter() - started) * 1000
+            documents += 1
+            yield item
+    finally:
+        items.close()
+        if rerun is not None:
+            rerun.record_call(operation, elapsed_ms, documents)
+
+# Wraps a storage backend so every public call is timed and counted against the current rerun
+class InstrumentedStorage:
+    # Local bookkeeping that never reaches the database
+    untimed = {"pool_stats"}
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getattr__(self, name):
+        attribute = getattr(self.storage, name)
+        if name.startswith("_") or name in self.untimed or not callable(attribute):
+            return attribute
+
+        def instrumented(*args, **kwargs):
+            with timed_call(name) as call:
+                result = attribute(*args, **kwargs)
+                if isinstance(result, GeneratorType):
+                    # The reads happen while the generator is consumed, so it is recorded then
+                    call["streamed"] = True
+                    return timed_iteration(name, result, current_rerun(), call["elapsed_ms"]())
+                call["documents"] = count_documents(result)
+            return result
+
+        instrumented.__name__ = name
+        return instrumented
@@ -0,0 +1,70 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from functools import lru_cache
+
+def parse_date(date_str):
+    return datetime.strptime(date_str, '%Y-%m-%d')
+
+def format_date(date_obj):
+    return date_obj.strftime('%Y-%m-%d')
+
+# Day keys in datetime.weekday() order
+DAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+# Prefix sums over two repeated weeks of a user's working hours, so any
+# partial week starting on any weekday is a single subtraction
+@lru_cache(maxsize=1024)
+def build_hours_calendar(week_hours):
+    prefix = [0.0]
+    for hours in week_hours + week_hours:
+        prefix.append(prefix[-1] + hours)
+    return tuple(prefix)
+
+def get_week_hours(settings):
+    return tuple(float(settings[f'{day}_hours']) for day in DAYS)
+
+def calculate_leave_hours(start_date, end_date, settings):
+    prefix = build_hours_calendar(get_week_hours(settings))
+    start = parse_date(start_date)
+    total_days = (parse_date(end_date) - start).days + 1
+    if total_days <= 0:
+        return 0
+
+    # Whole weeks in closed form, then the remaining days from the prefix sums
+    full_weeks, remaining_days = divmod(total_days, 7)
+    first_day = start.weekday()
+    return full_weeks * prefix[7] + prefix[first_day + remaining_days] - prefix[first_day]
+
+# In-memory interval index over a user's leaves for validating many candidate
+# ranges without a database round trip per range. Leaves are kept sorted by
+# start date next to the running maximum of their end dates, so a query
+# bisects both and only looks at leaves between the first whose running
+# maximum reaches start_date and the last starting by end_date.
+class LeaveIntervalIndex:
+    def __init__(self, leaves=()):
+        self._leaves = sorted(leaves, key=lambda leave: leave['start_date'])
+        self._starts = [leave['start_date'] for leave in self._leaves]
+        self._max_ends = []
+        for leave in self._leaves:
+            self._max_ends.append(max(self._max_ends[-1], leave['end_date']) if self._max_ends else leave['end_date'])
+
+    # Leaves added in date order, as imports usually are, are appended. Otherwise
+    # the running maximum is raised only up to the first leave already ending later.
+    def add(self, leave):
+        position = bisect_right(self._starts, leave['start_date'])
+        max_end = max(self._max_ends[position - 1], leave['end_date']) if position else leave['end_date']
+        self._starts.insert(position, leave['start_date'])
+        self._leaves.insert(position, leave)
+        self._max_ends.insert(position, max_end)
+        for later in range(position + 1, len(self._max_ends)):
+            if self._max_ends[later] >= max_end:
+                break
+            self._max_ends[later] = max_end
+
+    def overlaps(self, start_date, end_date):
+        first = bisect_left(self._max_ends, start_date)
+        last = bisect_right(self._starts, end_date)
+        return [leave for leave in self._leaves[first:last] if leave['end_date'] >= start_date]
+
+    def __len__(self):
+        return len(self._leaves)
@@ -0,0 +1,133 @@
+import csv
+import io
+from datetime import datetime, timedelta
+
+from leave_calc import calculate_leave_hours, format_date, parse_date
+
+# Columns written by the CSV export; an import needs at least start_date and end_date
+CSV_COLUMNS = ("start_date", "end_date", "hours", "requested_on")
+
+ICS_DATE_FORMAT = '%Y%m%d'
+
+# (line, start_date, end_date) for each data row of a CSV file with a header row
+def read_csv_ranges(text):
+    reader = csv.DictReader(io.StringIO(text))
+    columns = {(name or "").strip().lower().replace(" ", "_"): name for name in reader.fieldnames or ()}
+    if "start_date" not in columns or "end_date" not in columns:
+        raise ValueError("The CSV file needs 'start_date' and 'end_date' columns.")
+    for row in reader:
+        yield reader.line_num, (row[columns["start_date"]] or "").strip(), (row[columns["end_date"]] or "").strip()
+
+# RFC 5545 continuation lines start with a space or tab
+def unfold_ics_lines(text):
+    lines = []
+    for line in text.splitlines():
+        if line[:1] in (" ", "\t") and lines:
+            lines[-1] += line[1:]
+        else:
+            lines.append(line)
+    return lines
+
+def parse_ics_date(value):
+    return datetime.strptime(value[:8], ICS_DATE_FORMAT)
+
+# (line, start_date, end_date) for each non-cancelled VEVENT. All-day events
+# end on the day before DTEND, which is exclusive; timed events end on the day of DTEND.
+def read_ics_ranges(text):
+    event = None
+    for line_number, line in enumerate(unfold_ics_lines(text), start=1):
+        name, _, value = line.partition(":")
+        name, _, parameters = name.partition(";")
+        name = name.strip().upper()
+        if name == "BEGIN" and value.strip().upper() == "VEVENT":
+            event = {"line": line_number}
+        elif event is None:
+            continue
+        elif name in ("DTSTART", "DTEND", "STATUS"):
+            event[name] = (value.strip(), parameters.upper())
+        elif name == "END" and value.strip().upper() == "VEVENT":
+            if event.get("STATUS", ("",))[0].upper() != "CANCELLED":
+                yield event["line"], *ics_event_range(event)
+            event = None
+
+def ics_event_range(event):
+    if "DTSTART" not in event:
+        return "", ""
+    try:
+        start_value = event["DTSTART"][0]
+        start = parse_ics_date(start_value)
+        if "DTEND" not in event:
+            return format_date(start), format_date(start)
+        end_value = event["DTEND"][0]
+        end = parse_ics_date(end_value)
+        if len(end_value) == 8 or end_value[9:15] == "000000":
+            end -= timedelta(days=1)
+        return format_date(start), format_date(max(start, end))
+    except ValueError:
+        return event["DTSTART"][0], event.get("DTEND", ("",))[0]
+
+def read_import_ranges(filename, text):
+    if filename.lower().endswith(".ics"):
+        return read_ics_ranges(text)
+    return read_csv_ranges(text)
+
+# Validates every range in one pass against an in-memory index of the user's
+# leaves, which also receives each accepted range so overlaps within the file
+# are caught too. Hours come from the user's working-hours settings; leave
+# starting in an archived year is rejected.
+# Returns (leaves to book, [(line, message)] for rejected rows).
+def validate_import(ranges, settings, index, archived_years=()):
+    leaves, errors = [], []
+    for line, start_date, end_date in ranges:
+        try:
+            start, end = parse_date(start_date), parse_date(end_date)
+        except ValueError:
+            errors.append((line, f"Invalid dates '{start_date}' to '{end_date}', expected YYYY-MM-DD."))
+            continue
+        if end < start:
+            errors.append((line, f"End date {end_date} is before start date {start_date}."))
+            continue
+        if start.year in archived_years:
+            errors.append((line, f"{start.year} is closed and archived."))
+            continue
+        start_date, end_date = format_date(start), format_date(end)
+        if overlapping := index.overlaps(start_date, end_date):
+            conflict = overlapping[0]
+            source = "an earlier row" if conflict.get("_id") is None else "existing leave"
+            errors.append((line, f"Overlaps {source} from {conflict['start_date']} to {conflict['end_date']}."))
+            continue
+        leave = {
+            "start_date": start_date,
+            "end_date": end_date,
+            "hours": float(calculate_leave_hours(start_date, end_date, settings))
+        }
+        index.add(leave)
+        leaves.append(leave)
+    return leaves, errors
+
+def export_csv(leaves):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    for leave in leaves:
+        writer.writerow([leave.get(column, "") for column in CSV_COLUMNS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def export_ics(leaves):
+    yield "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//Leave Tracker//EN\r\n"
+    for leave in leaves:
+        end = parse_date(leave["end_date"]) + timedelta(days=1)
+        stamp = datetime.strptime(leave["requested_on"], '%Y-%m-%d %H:%M:%S') if leave.get("requested_on") else datetime.now()
+        yield (
+            "BEGIN:VEVENT\r\n"
+            f"UID:leave-{leave['_id']}@leave-tracker\r\n"
+            f"DTSTAMP:{stamp.strftime('%Y%m%dT%H%M%S')}\r\n"
+            f"DTSTART;VALUE=DATE:{parse_date(leave['start_date']).strftime(ICS_DATE_FORMAT)}\r\n"
+            f"DTEND;VALUE=DATE:{end.strftime(ICS_DATE_FORMAT)}\r\n"
+            f"SUMMARY:Annual leave ({leave['hours']} hours)\r\n"
+            "END:VEVENT\r\n"
+        )
+    yield "END:VCALENDAR\r\n"
@@ -0,0 +1,42 @@
+# Online migration of legacy MongoDB documents to the native schema: leave
+# dates and requested_on become BSON dates, hours and settings become doubles.
+#
+# The app keeps reading both formats while this runs, so it can be executed
+# against a live database. It is safe to interrupt and re-run; each run only
+# touches documents that still need converting.
+#
+#   python migrate.py --connection-string "mongodb+srv://..." --batch-size 1000
+import argparse
+import os
+
+from storage import MongoStorage
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert leave tracker documents to native BSON dates and doubles.")
+    parser.add_argument(
+        "--connection-string",
+        default=os.environ.get("MONGO_CONNECTION_STRING"),
+        help="MongoDB connection string (defaults to $MONGO_CONNECTION_STRING)"
+    )
+    parser.add_argument("--database", default="leave_tracker")
+    parser.add_argument("--batch-size", type=int, default=1000, help="documents per bulk_write")
+    args = parser.parse_args()
+    if not args.connection_string:
+        parser.error("a connection string is required")
+
+    storage = MongoStorage(args.connection_string, database=args.database)
+    storage.bootstrap()
+    if storage.native_dates:
+        print("Nothing to migrate: all documents already use the native schema.")
+        return
+
+    def progress(collection, converted):
+        print(f"{collection}: {converted} documents converted")
+
+    converted = storage.migrate_native_types(batch_size=args.batch_size, progress=progress)
+    print(f"Done: {converted['leaves']} leaves and {converted['settings']} settings documents converted.")
+    if not storage.native_dates:
+        print("Documents in the old format were written during the run; run the migration again to finish.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import base64
+import hashlib
+import hmac
+import secrets
+from functools import lru_cache
+
+# scrypt cost for new hashes. n must be a power of two and sets both the CPU
+# cost and the memory each hash needs (128 * n * r bytes, 16 MiB by default).
+DEFAULT_SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+def scrypt(password, salt, n, r, p, key_bytes=KEY_BYTES):
+    return hashlib.scrypt(
+        password.encode('utf-8'), salt=salt, n=n, r=r, p=p, dklen=key_bytes, maxmem=256 * n * r
+    )
+
+def encode(raw):
+    return base64.b64encode(raw).decode('ascii')
+
+# "scrypt$<n>$<r>$<p>$<salt>$<key>" with a random salt, salt and key in base64
+def hash_password(password, n=DEFAULT_SCRYPT_N):
+    salt = secrets.token_bytes(SALT_BYTES)
+    return f"scrypt${n}${SCRYPT_R}${SCRYPT_P}${encode(salt)}${encode(scrypt(password, salt, n, SCRYPT_R, SCRYPT_P))}"
+
+# Unsalted sha256 hex digests stored before scrypt was introduced
+def is_legacy_hash(stored):
+    return len(stored) == 64 and all(character in "0123456789abcdef" for character in stored)
+
+# Checked in place of a missing user's hash so unknown usernames take as long as wrong passwords
+@lru_cache(maxsize=None)
+def dummy_hash(n):
+    return hash_password(secrets.token_hex(16), n)
+
+# Returns (matches, needs_rehash). Legacy hashes and hashes made with other cost
+# parameters than n need rehashing once the password has been checked against them.
+# A stored hash of None never matches.
+def verify_password(password, stored, n=DEFAULT_SCRYPT_N):
+    if stored is None:
+        verify_password(password, dummy_hash(n), n)
+        return False, False
+    if stored.startswith("scrypt$"):
+        try:
+            _, cost, r, p, salt, key = stored.split("$")
+            cost, r, p = int(cost), int(r), int(p)
+            salt, key = base64.b64decode(salt), base64.b64decode(key)
+            derived = scrypt(password, salt, cost, r, p, len(key))
+        except ValueError:
+            return False, False
+        matches = hmac.compare_digest(derived, key)
+        return matches, matches and (cost, r, p) != (n, SCRYPT_R, SCRYPT_P)
+    if is_legacy_hash(stored):
+        matches = hmac.compare_digest(hashlib.sha256(password.encode('utf-8')).hexdigest(), stored)
+        return matches, matches
+    return False, False
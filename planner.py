@@ -0,0 +1,145 @@
+from datetime import date, timedelta
+
+import numpy as np
+import streamlit as st
+
+from leave_calc import format_date, get_week_hours, parse_date
+
+# Longest booking the planner proposes, in calendar days
+DEFAULT_MAX_LENGTH = 14
+# Options shown by the planner page
+DEFAULT_OPTIONS = 10
+
+# Runs of consecutive True values ending at each position (or, reversed, starting at it)
+def run_lengths(flags):
+    positions = np.arange(len(flags))
+    last_false = np.maximum.accumulate(np.where(flags, -1, positions))
+    return positions - last_false
+
+# Scores every booking that starts and ends on a working day inside the window,
+# costs at most budget_hours and does not touch existing leave, all as one
+# (start day x length) array operation. Days off count the booked range plus the
+# zero-hour days it bridges on either side. Options are ranked by days off per
+# leave hour and returned without overlapping each other.
+def plan_leave(window_start, window_end, budget_hours, settings, existing_leaves,
+               max_length=DEFAULT_MAX_LENGTH, options=DEFAULT_OPTIONS):
+    first_day = parse_date(window_start)
+    day_count = (parse_date(window_end) - first_day).days + 1
+    if day_count <= 0 or budget_hours <= 0:
+        return []
+
+    weekdays = (np.arange(day_count) + first_day.weekday()) % 7
+    hours = np.asarray(get_week_hours(settings), dtype=np.float64)[weekdays]
+    booked = np.zeros(day_count, dtype=bool)
+    for leave in existing_leaves:
+        low = max((parse_date(leave['start_date']) - first_day).days, 0)
+        high = min((parse_date(leave['end_date']) - first_day).days, day_count - 1)
+        if low <= high:
+            booked[low:high + 1] = True
+
+    hours_prefix = np.concatenate(([0.0], np.cumsum(hours)))
+    booked_prefix = np.concatenate(([0], np.cumsum(booked)))
+    free = hours == 0
+    free_before = np.concatenate(([0], run_lengths(free)[:-1]))
+    free_after = np.concatenate((run_lengths(free[::-1])[::-1][1:], [0]))
+
+    starts = np.arange(day_count)[:, None]
+    ends = starts + np.arange(max_length)[None, :]
+    in_window = ends < day_count
+    ends = np.minimum(ends, day_count - 1)
+
+    cost = hours_prefix[ends + 1] - hours_prefix[starts]
+    clashes = booked_prefix[ends + 1] - booked_prefix[starts]
+    valid = (
+        in_window
+        & (clashes == 0)
+        & (cost > 0)
+        & (cost <= budget_hours)
+        & ~free[starts]
+        & ~free[ends]
+    )
+    days_off = (ends - starts + 1) + free_before[starts] + free_after[ends]
+    score = np.where(valid, days_off / np.where(valid, cost, 1.0), -1.0)
+
+    # Best ratio first, then more days off, then the earlier start
+    start_index, length_index = np.nonzero(valid)
+    order = np.lexsort((
+        start_index,
+        -days_off[start_index, length_index],
+        -score[start_index, length_index],
+    ))
+
+    chosen, taken = [], np.zeros(day_count, dtype=bool)
+    for position in order:
+        start, end = start_index[position], ends[start_index[position], length_index[position]]
+        off_start, off_end = start - free_before[start], end + free_after[end]
+        if taken[off_start:off_end + 1].any():
+            continue
+        taken[off_start:off_end + 1] = True
+        chosen.append({
+            "start_date": format_date(first_day + timedelta(days=int(start))),
+            "end_date": format_date(first_day + timedelta(days=int(end))),
+            "hours": float(cost[start, length_index[position]]),
+            "days_off": int(days_off[start, length_index[position]]),
+            "off_from": format_date(first_day + timedelta(days=int(off_start))),
+            "off_to": format_date(first_day + timedelta(days=int(off_end))),
+            "days_per_hour": float(score[start, length_index[position]]),
+        })
+        if len(chosen) == options:
+            break
+    return chosen
+
+def render_planner_page(storage, user_id, user_settings, book_leave, archived_years=()):
+    st.subheader("🧭 Leave Planner")
+
+    today = date.today()
+    col1, col2, col3 = st.columns(3)
+    window_start = col1.date_input("From", today, key="planner_start")
+    window_end = col2.date_input("To", today + timedelta(days=180), key="planner_end")
+    budget = col3.number_input(
+        "Hours to spend", min_value=0.0, value=float(user_settings['leave_balance']), step=0.5, key="planner_budget"
+    )
+    max_length = st.slider("Longest booking (days)", 1, 31, DEFAULT_MAX_LENGTH, key="planner_max_length")
+    if window_end < window_start:
+        st.error("'To' must be on or after 'From'.")
+        return
+
+    start_date, end_date = format_date(window_start), format_date(window_end)
+    existing = storage.find_overlaps(user_id, start_date, end_date, limit=0)
+    # Archived years are read-only, so they are planned around like booked leave
+    existing += [
+        {"start_date": f"{year:04d}-01-01", "end_date": f"{year:04d}-12-31"}
+        for year in archived_years if window_start.year <= year <= window_end.year
+    ]
+    plans = plan_leave(start_date, end_date, min(budget, user_settings['leave_balance']), user_settings, existing, max_length)
+    if not plans:
+        st.info("No bookings fit this window and budget.")
+        return
+
+    selection = st.dataframe(
+        [
+            {
+                "Book from": plan["start_date"],
+                "Book to": plan["end_date"],
+                "Hours": plan["hours"],
+                "Days off": plan["days_off"],
+                "Off from": plan["off_from"],
+                "Off to": plan["off_to"],
+                "Days per hour": round(plan["days_per_hour"], 3),
+            }
+            for plan in plans
+        ],
+        hide_index=True,
+        use_container_width=True,
+        on_select="rerun",
+        selection_mode="single-row",
+        key="planner_table"
+    )
+    rows = selection["selection"]["rows"]
+    if st.button("Book Selected", key="planner_book", disabled=not rows):
+        plan = plans[rows[0]]
+        if book_leave(user_id, plan["start_date"], plan["end_date"], plan["hours"]) is None:
+            st.warning("⚠️ Warning: The requested hours exceed your remaining leave balance. Please adjust your request.")
+        else:
+            st.success(f"✅ Booked {plan['start_date']} to {plan['end_date']}.")
+            st.rerun()
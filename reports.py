@@ -0,0 +1,147 @@
+import calendar
+from datetime import date, timedelta
+
+import streamlit as st
+
+# Report results are cached per process. Callers pass the data version of the
+# user (or of the whole team) so any leave write invalidates the cached result;
+# the TTL only bounds staleness from writes made by other server processes.
+REPORT_CACHE_TTL_SECONDS = 600
+
+@st.cache_data(ttl=REPORT_CACHE_TTL_SECONDS, show_spinner=False)
+def cached_report(_storage, report, args, version):
+    return getattr(_storage, report)(*args)
+
+# Straight-line projection of the balance at year end from this year's average monthly usage
+def project_year_end_balance(balance, monthly_usage, today):
+    elapsed_months = today.month - 1 + today.day / calendar.monthrange(today.year, today.month)[1]
+    if elapsed_months <= 0:
+        return balance
+    hours_per_month = sum(month["hours"] for month in monthly_usage) / elapsed_months
+    return balance - hours_per_month * (12 - elapsed_months)
+
+def render_reports_page(storage, user_id, user_settings, user_version, team_version):
+    st.subheader("📊 Reports")
+
+    yearly = cached_report(storage, "usage_by_year", (user_id,), user_version)
+    today = date.today()
+    years = sorted({row["year"] for row in yearly} | {today.year}, reverse=True)
+    year = st.selectbox("Year", years, key="report_year")
+
+    monthly = cached_report(storage, "usage_by_month", (user_id, year), user_version)
+    hours_by_month = {row["month"]: row["hours"] for row in monthly}
+
+    col1, col2, col3 = st.columns(3)
+    col1.metric(f"Hours used in {year}", sum(hours_by_month.values()))
+    col2.metric("Leave requests", sum(row["count"] for row in monthly))
+    if year == today.year:
+        projected = project_year_end_balance(user_settings['leave_balance'], monthly, today)
+        col3.metric("Projected balance at year end", f"{projected:.1f}")
+    else:
+        col3.metric("Current balance", user_settings['leave_balance'])
+
+    st.write("**Hours by month**")
+    st.bar_chart(
+        {
+            "Month": [f"{month:02d} {calendar.month_abbr[month]}" for month in range(1, 13)],
+            "Hours": [hours_by_month.get(month, 0.0) for month in range(1, 13)]
+        },
+        x="Month",
+        y="Hours"
+    )
+
+    st.write("**Hours by year**")
+    st.dataframe(
+        [{"Year": str(row["year"]), "Hours": row["hours"], "Leave requests": row["count"]} for row in yearly],
+        hide_index=True,
+        use_container_width=True
+    )
+
+    st.subheader("🧾 Balance Ledger")
+    as_of = st.date_input("Balance as of", today, key="ledger_as_of")
+    as_of_balance = cached_report(storage, "balance_as_of", (user_id, as_of.strftime('%Y-%m-%d')), user_version)
+    if as_of_balance is None:
+        st.metric(f"Balance at the end of {as_of.strftime('%Y-%m-%d')}", "—")
+        ledger_start = cached_report(storage, "ledger_start", (user_id,), user_version)
+        st.caption(
+            f"Your ledger starts on {ledger_start[:10]}; balances before then were not recorded."
+            if ledger_start else "Your balance has no recorded history yet."
+        )
+    else:
+        st.metric(f"Balance at the end of {as_of.strftime('%Y-%m-%d')}", f"{as_of_balance:.1f}")
+    events = cached_report(storage, "ledger_events", (user_id,), user_version)
+    st.dataframe(
+        [
+            {"#": event["seq"], "When": event["at"], "Event": event["kind"].capitalize(), "Hours": event["hours"]}
+            for event in events
+        ],
+        hide_index=True,
+        use_container_width=True
+    )
+
+    st.subheader("👥 Team Usage")
+    team = cached_report(storage, "team_usage", (year,), team_version)
+    if not team:
+        st.info(f"No leave recorded for {year}.")
+        return
+
+    st.dataframe(
+        [{"User": row["username"], "Hours": row["hours"], "Leave requests": row["count"]} for row in team],
+        hide_index=True,
+        use_container_width=True
+    )
+    distribution = cached_report(storage, "team_hours_distribution", (year,), team_version)
+    st.write("**People by hours taken**")
+    st.bar_chart(
+        {
+            "Hours taken": [
+                f"{bucket['min_hours']:03.0f}–{bucket['max_hours']:03.0f}" if bucket['max_hours'] < 1e9 else f"{bucket['min_hours']:.0f}+"
+                for bucket in distribution
+            ],
+            "People": [bucket["users"] for bucket in distribution]
+        },
+        x="Hours taken",
+        y="People"
+    )
+
+# Who is off on each day, from the occupancy the storage layer keeps up to date on every booking
+def render_team_calendar_page(storage, team_version):
+    st.subheader("📅 Team Calendar")
+
+    today = date.today()
+    col1, col2 = st.columns(2)
+    start = col1.date_input("From", today, key="calendar_start")
+    end = col2.date_input("To", today + timedelta(days=90), key="calendar_end")
+    if end < start:
+        st.error("'To' must be on or after 'From'.")
+        return
+
+    days = cached_report(
+        storage, "team_calendar", (start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')), team_version
+    )
+    if not days:
+        st.info("Nobody is off in this period.")
+        return
+
+    st.write("**People off per day**")
+    st.bar_chart(
+        {"Date": [day["date"] for day in days], "People off": [len(day["user_ids"]) for day in days]},
+        x="Date",
+        y="People off"
+    )
+
+    usernames = cached_report(
+        storage, "get_usernames", (tuple(sorted({user_id for day in days for user_id in day["user_ids"]})),), team_version
+    )
+    st.dataframe(
+        [
+            {
+                "Date": day["date"],
+                "People off": len(day["user_ids"]),
+                "Who": ", ".join(sorted(usernames.get(user_id, "(deleted)") for user_id in day["user_ids"]))
+            }
+            for day in days
+        ],
+        hide_index=True,
+        use_container_width=True
+    )
@@ -0,0 +1,78 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+# Written by a server process once its warm-up has finished; healthcheck.py --ready reads it
+DEFAULT_READY_FILE = os.path.join(tempfile.gettempdir(), "leave_tracker.ready")
+
+# Runs the first-use work of a server process (database client, SRV lookup and
+# first connection, schema bootstrap, imports only needed after login) on a
+# background thread, so the first session paints its login form without
+# waiting for it. steps is a list of (name, callable). When every step has
+# succeeded the readiness file is written; after a failed step the process
+# stays not ready and the next start() tries again.
+class Warmup:
+    def __init__(self, steps, ready_file=DEFAULT_READY_FILE):
+        self.steps = steps
+        self.ready_file = ready_file
+        self.timings = {}
+        self.error = None
+        self.ready = False
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self.ready or (self._thread is not None and self._thread.is_alive()):
+                return self
+            self.error = None
+            self._thread = threading.Thread(target=self._run, name="leave-warmup", daemon=True)
+            self._thread.start()
+        return self
+
+    # Blocks until the running warm-up finishes or timeout seconds pass; returns whether the process is ready
+    def wait(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.ready
+
+    def _run(self):
+        for name, step in self.steps:
+            started = time.perf_counter()
+            try:
+                step()
+            except Exception as e:
+                self.error = f"{name}: {e}"
+                return
+            self.timings[name] = round((time.perf_counter() - started) * 1000, 3)
+        write_ready_file(self.ready_file, self.timings)
+        self.ready = True
+
+def write_ready_file(path, timings):
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as ready_file:
+        json.dump({
+            "pid": os.getpid(),
+            "ready_at": datetime.now().isoformat(timespec="seconds"),
+            "steps_ms": timings,
+        }, ready_file)
+    os.replace(temporary_path, path)
+
+# The readiness record, or None if it is missing, unreadable or left behind by
+# a process that is no longer running
+def read_ready_file(path):
+    try:
+        with open(path) as ready_file:
+            record = json.load(ready_file)
+    except (OSError, ValueError):
+        return None
+    try:
+        os.kill(int(record["pid"]), 0)
+    except PermissionError:
+        pass  # Running as another user
+    except (OSError, KeyError, TypeError, ValueError):
+        return None
+    return record
@@ -0,0 +1,1920 @@
+import heapq
+import sqlite3
+import threading
+from bisect import bisect_right
+from collections import Counter
+from itertools import chain, islice
+from datetime import date, datetime, timedelta
+
+from bson.objectid import ObjectId
+from pymongo import MongoClient, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import DuplicateKeyError
+
+from storage_common import HISTORY_FIELDS, HISTORY_PAGE_SIZE, UsernameTakenError
+
+# Default working hours and balance for new users
+DEFAULT_SETTINGS = {
+    "mon_hours": 7.5,
+    "tue_hours": 0.0,
+    "wed_hours": 10.5,
+    "thu_hours": 11.5,
+    "fri_hours": 8.5,
+    "sat_hours": 0.0,
+    "sun_hours": 0.0,
+    "leave_balance": 307.5  # Updated default leave balance
+}
+
+# Fields a settings update may touch
+SETTINGS_FIELDS = tuple(DEFAULT_SETTINGS)
+
+# Default connection pool settings, overridable from the [mongo] secrets section
+DEFAULT_POOL_SETTINGS = {
+    "max_pool_size": 50,
+    "min_pool_size": 0,
+    "max_idle_time_ms": 300000,
+    "connect_timeout_ms": 5000,
+    "server_selection_timeout_ms": 5000,
+    "wait_queue_timeout_ms": 2000,
+}
+
+# Leaves fetched per round trip when streaming a whole history for export
+EXPORT_BATCH_SIZE = 500
+
+# Leaves deleted per transaction by the batched deletes that background jobs run
+DELETE_BATCH_SIZE = 200
+
+# Balance ledger: a snapshot of the running balance is kept every
+# LEDGER_SNAPSHOT_INTERVAL events, so any balance is a snapshot plus a short replay
+LEDGER_SNAPSHOT_INTERVAL = 100
+LEDGER_PAGE_SIZE = 50
+LEDGER_KINDS = ("grant", "adjust", "booking", "refund")
+
+# Upper bounds (exclusive) of the per-user yearly hours buckets in the team report
+TEAM_HOURS_BUCKETS = [0, 40, 80, 120, 160, 200, 240, 1e9]
+
+DATE_FORMAT = '%Y-%m-%d'
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def requested_on_now():
+    return datetime.now().strftime(TIMESTAMP_FORMAT)
+
+def to_datetime(date_str, date_format=DATE_FORMAT):
+    return datetime.strptime(date_str, date_format)
+
+def iter_days(start_date, end_date):
+    day, last_day = to_datetime(start_date), to_datetime(end_date)
+    while day <= last_day:
+        yield day
+        day += timedelta(days=1)
+
+# Per-day change in occupancy for a user's leaves, given (start_date, end_date) pairs
+def occupancy_changes(ranges, delta):
+    changes = Counter()
+    for start_date, end_date in ranges:
+        for day in iter_days(start_date, end_date):
+            changes[day] += delta
+    return changes
+
+# Ledger events are numbered per user by settings.ledger_seq, which each balance
+# write increments in the same atomic update as leave_balance, so a sequence
+# number and the balance after it always agree. events are (kind, hours, leave_id).
+def ledger_entries(user_id, events, last_seq, at):
+    first_seq = last_seq - len(events) + 1
+    return [
+        {
+            "user_id": str(user_id),
+            "seq": first_seq + offset,
+            "at": at,
+            "kind": kind,
+            "hours": float(hours),
+            "leave_id": None if leave_id is None else str(leave_id),
+        }
+        for offset, (kind, hours, leave_id) in enumerate(events)
+    ]
+
+# True when a write of count events ending at last_seq crosses a snapshot boundary
+def snapshot_due(last_seq, count):
+    return last_seq // LEDGER_SNAPSHOT_INTERVAL > (last_seq - count) // LEDGER_SNAPSHOT_INTERVAL
+
+# Replays (seq, at, hours) events in sequence order on top of a snapshot.
+# Returns the final balance and the (seq, at, balance) snapshots to store on the way.
+def replay_ledger(base_seq, balance, events):
+    snapshots = []
+    for seq, at, hours in events:
+        balance += float(hours)
+        if snapshot_due(seq, seq - base_seq):
+            snapshots.append((seq, at, balance))
+        base_seq = seq
+    return balance, snapshots
+
+# Events recorded before the end of as_of (a YYYY-MM-DD date) count towards its balance
+def ledger_cutoff(as_of):
+    return None if as_of is None else to_datetime(as_of) + timedelta(days=1)
+
+def year_range(year):
+    return f"{year:04d}-01-01", f"{year:04d}-12-31"
+
+# Hours carried into the next year from a closing balance, and the hours
+# forfeited above carry_over_limit (never more than is left to forfeit now).
+# An unknown closing balance carries over an unknown amount and forfeits nothing.
+def carry_over(closing_balance, current_balance, carry_over_limit=None):
+    if closing_balance is None:
+        return None, 0.0
+    if carry_over_limit is None or closing_balance <= carry_over_limit:
+        return closing_balance, 0.0
+    forfeited = min(closing_balance - carry_over_limit, max(current_balance, 0.0))
+    return closing_balance - forfeited, forfeited
+
+# Adds archived years, from their summaries, to yearly usage of the active partition
+def merge_year_summaries(usage, summaries):
+    years = {row["year"]: dict(row) for row in usage}
+    for summary in summaries:
+        if summary["count"]:
+            row = years.setdefault(summary["year"], {"year": summary["year"], "hours": 0.0, "count": 0})
+            row["hours"] += summary["hours"]
+            row["count"] += summary["count"]
+    return [years[year] for year in sorted(years)]
+
+# Totals for archive_year from each user's (leaves moved, closing balance), None for users already archived
+def count_archived(results):
+    archived = {"users": 0, "leaves": 0, "unknown_balances": 0}
+    for result in results:
+        if result is not None:
+            moved, closing_balance = result
+            archived["users"] += 1
+            archived["leaves"] += moved
+            archived["unknown_balances"] += closing_balance is None
+    return archived
+
+def check_settings_fields(updates):
+    unknown = set(updates) - set(SETTINGS_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown settings fields: {', '.join(sorted(unknown))}")
+
+# MongoDB stores leave dates and requested_on as native BSON dates and every
+# hours value as a double. Documents written before that schema still hold
+# strings and ints; both are read back as the string/float leave dicts the
+# storage interface promises.
+def leave_from_document(document):
+    for field in ("start_date", "end_date"):
+        if isinstance(document.get(field), datetime):
+            document[field] = document[field].strftime(DATE_FORMAT)
+    if isinstance(document.get("requested_on"), datetime):
+        document["requested_on"] = document["requested_on"].strftime(TIMESTAMP_FORMAT)
+    if "hours" in document:
+        document["hours"] = float(document["hours"])
+    return document
+
+# $set for the fields of a legacy leave document that still need converting
+def native_leave_fields(document):
+    fields = {}
+    for field in ("start_date", "end_date"):
+        if isinstance(document.get(field), str):
+            fields[field] = to_datetime(document[field])
+    if isinstance(document.get("requested_on"), str):
+        fields["requested_on"] = to_datetime(document["requested_on"], TIMESTAMP_FORMAT)
+    if "hours" in document and not isinstance(document["hours"], float):
+        fields["hours"] = float(document["hours"])
+    return fields
+
+LEGACY_LEAVE_FILTER = {"$or": [
+    {"start_date": {"$type": "string"}},
+    {"end_date": {"$type": "string"}},
+    {"requested_on": {"$type": "string"}},
+    {"hours": {"$exists": True, "$not": {"$type": "double"}}},
+]}
+LEGACY_SETTINGS_FILTER = {"$or": [
+    {field: {"$exists": True, "$not": {"$type": "double"}}} for field in SETTINGS_FIELDS
+]}
+
+# Storage interface shared by every backend. Leaves are dicts with "_id",
+# "user_id", "start_date", "end_date" (YYYY-MM-DD strings), "hours" and
+# "requested_on"; settings are dicts with "user_id" plus SETTINGS_FIELDS.
+class LeaveStorage:
+    name = "base"
+
+    # Bring the schema up to date and return its version
+    def bootstrap(self):
+        raise NotImplementedError
+
+    def ping(self):
+        raise NotImplementedError
+
+    def pool_stats(self):
+        return {}
+
+    # Users
+    def create_user(self, username, password_hash):
+        raise NotImplementedError
+
+    # (user_id, stored password hash) for the username, or None. Passwords are
+    # verified by the caller, so the hash format can change without a query change.
+    def find_credentials(self, username):
+        raise NotImplementedError
+
+    # Replaces the stored hash only if it is still old_hash, so a rehash on login
+    # cannot overwrite a password changed in the meantime. Returns whether it did.
+    def set_password_hash(self, user_id, old_hash, new_hash):
+        raise NotImplementedError
+
+    def delete_user(self, user_id):
+        raise NotImplementedError
+
+    # Deletes the user's leaves batch_size at a time, then the account, calling
+    # progress(deleted, total) after every batch. Meant for a background job.
+    def delete_user_in_batches(self, user_id, batch_size=DELETE_BATCH_SIZE, progress=None):
+        self.cancel_all_leaves_in_batches(user_id, batch_size, progress)
+        self.delete_user(user_id)
+
+    # Settings
+    def get_settings(self, user_id):
+        raise NotImplementedError
+
+    def update_settings(self, user_id, updates):
+        raise NotImplementedError
+
+    # Leaves
+    def list_leaves(self, user_id):
+        raise NotImplementedError
+
+    # Every leave of the user in start-date order, fetched in batches so an
+    # export never holds the whole history in memory
+    def iter_leaves(self, user_id, batch_size=EXPORT_BATCH_SIZE):
+        raise NotImplementedError
+
+    # One page of history sorted by start date, optionally limited to leaves
+    # starting in one year; fetches limit + 1 rows to report whether more exist.
+    # In an archived year, rows from the archive carry "archived": True while
+    # leaves left active (those running into the next year) carry False.
+    # Returns (leaves, has_more).
+    def list_leaves_page(self, user_id, year=None, limit=HISTORY_PAGE_SIZE):
+        raise NotImplementedError
+
+    # Years with at least one leave starting in them, most recent first
+    def leave_years(self, user_id):
+        raise NotImplementedError
+
+    # {"hours": ..., "count": ...} for leaves starting in the year, computed server-side
+    def leave_totals(self, user_id, year):
+        raise NotImplementedError
+
+    # Reports, computed server-side. Leaves are attributed to the month/year they start in.
+    # [{"month": 1-12, "hours": ..., "count": ...}] for months with leave
+    def usage_by_month(self, user_id, year):
+        raise NotImplementedError
+
+    # [{"year": ..., "hours": ..., "count": ...}] oldest first
+    def usage_by_year(self, user_id):
+        raise NotImplementedError
+
+    # [{"user_id": ..., "username": ..., "hours": ..., "count": ...}] for every user with leave in the year
+    def team_usage(self, year):
+        raise NotImplementedError
+
+    # [{"min_hours": ..., "max_hours": ..., "users": ...}] over TEAM_HOURS_BUCKETS
+    def team_hours_distribution(self, year):
+        raise NotImplementedError
+
+    # Team availability, read from the per-day occupancy maintained by every
+    # leave write: [{"date": "YYYY-MM-DD", "user_ids": [...]}] for days in the
+    # range on which anyone is off, in date order
+    def team_calendar(self, start_date, end_date):
+        raise NotImplementedError
+
+    # Recomputes the occupancy from the leaves, e.g. after a data fix
+    def rebuild_occupancy(self):
+        raise NotImplementedError
+
+    # {user_id: username} for the given ids
+    def get_usernames(self, user_ids):
+        raise NotImplementedError
+
+    def find_overlaps(self, user_id, start_date, end_date, limit=1):
+        raise NotImplementedError
+
+    # Atomic balance operations; each returns the new balance
+    def book_leave(self, user_id, start_date, end_date, hours):
+        raise NotImplementedError
+
+    # Books many leaves ({"start_date", "end_date", "hours"}) with one balance
+    # deduction for their total and one bulk insert. Returns the new balance,
+    # or None if the balance does not cover the total, in which case nothing is booked.
+    def import_leaves(self, user_id, leaves):
+        raise NotImplementedError
+
+    def cancel_leave(self, user_id, leave_id):
+        raise NotImplementedError
+
+    # Deletes the given leaves and refunds exactly the hours of those that still existed
+    def cancel_leaves(self, user_id, leave_ids):
+        raise NotImplementedError
+
+    def cancel_all_leaves(self, user_id):
+        raise NotImplementedError
+
+    # cancel_all_leaves as a series of cancel_leaves calls, each atomic with its
+    # own refund, so a long history never needs one huge transaction and
+    # progress(deleted, total) can be reported after every batch. Leaves booked
+    # while it runs are swept up by a final cancel_all_leaves. Returns the new balance.
+    def cancel_all_leaves_in_batches(self, user_id, batch_size=DELETE_BATCH_SIZE, progress=None):
+        leave_ids = [leave["_id"] for leave in self.list_leaves(user_id)]
+        for offset in range(0, len(leave_ids), batch_size):
+            self.cancel_leaves(user_id, leave_ids[offset:offset + batch_size])
+            if progress:
+                progress(min(offset + batch_size, len(leave_ids)), len(leave_ids))
+        return self.cancel_all_leaves(user_id)
+
+    # Balance ledger: every change to leave_balance is also appended as an
+    # event (kind in LEDGER_KINDS, signed hours, optional leave_id)
+
+    # Most recent events first: [{"seq", "at", "kind", "hours", "leave_id"}]
+    def ledger_events(self, user_id, limit=LEDGER_PAGE_SIZE):
+        raise NotImplementedError
+
+    # When the user's ledger starts (YYYY-MM-DD HH:MM:SS): the time of their
+    # opening grant, which is when the account was created or, for accounts
+    # older than the ledger, when the v4 migration seeded it. None without a ledger.
+    def ledger_start(self, user_id):
+        raise NotImplementedError
+
+    # Balance at the end of the as_of date (YYYY-MM-DD), or now if None, from
+    # the nearest snapshot plus the events after it. None if the ledger starts
+    # after that date, since earlier balances were never recorded.
+    def balance_as_of(self, user_id, as_of=None):
+        raise NotImplementedError
+
+    # Recomputes settings.leave_balance from the ledger and returns it. After a
+    # fix to events from from_seq on, pass from_seq so the snapshots from there
+    # on are discarded and rebuilt; otherwise only events after the latest
+    # snapshot are replayed.
+    def rebuild_balance(self, user_id, from_seq=None):
+        raise NotImplementedError
+
+    # Hot/cold partitioning: leaves of closed years move out of the working
+    # set into an archive with one summary per user and year. Overlap checks
+    # and the current years only read the active partition; history and
+    # reports for an archived year read both.
+
+    def archived_years(self):
+        raise NotImplementedError
+
+    # Archives every leave starting and ending in year (which must be over) for
+    # all users, one user at a time. Each user's summary records the balance at
+    # the end of the year and how much of it carried over; with a
+    # carry_over_limit the excess is forfeited as a ledger adjustment. For a
+    # user whose ledger starts after the year the closing balance is unknown:
+    # their leaves are archived with closing_balance and carried_over None and
+    # nothing is forfeited. Safe to re-run. Returns {"users": <archived>,
+    # "leaves": <moved>, "unknown_balances": <users archived without a closing balance>}.
+    def archive_year(self, year, carry_over_limit=None):
+        raise NotImplementedError
+
+    # [{"year", "hours", "count", "closing_balance", "carried_over", "forfeited", "archived_on"}], oldest first;
+    # closing_balance and carried_over are None where the ledger started after the year
+    def year_summaries(self, user_id):
+        raise NotImplementedError
+
+# Counts connection pool events so the pool can be sized from real usage
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {
+            "created": 0,
+            "closed": 0,
+            "checked_out": 0,
+            "waiting": 0,
+            "checkout_failed": 0,
+            "pool_cleared": 0,
+        }
+
+    def _add(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["open"] = stats["created"] - stats["closed"]
+        return stats
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._add("pool_cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._add("created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add("closed")
+
+    def connection_check_out_started(self, event):
+        self._add("waiting")
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self._stats["waiting"] -= 1
+            self._stats["checkout_failed"] += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self._stats["waiting"] -= 1
+            self._stats["checked_out"] += 1
+
+    def connection_checked_in(self, event):
+        self._add("checked_out", -1)
+
+# MongoDB schema migrations, applied in order; each entry brings the database up to that version
+def migrate_mongo_v1_indexes(db):
+    existing = set(db.list_collection_names())
+    for name in ("users", "leaves", "settings"):
+        if name not in existing:
+            db.create_collection(name)
+    db.users.create_index("username", unique=True, name="username_unique")
+    db.settings.create_index("user_id", unique=True, name="user_id_unique")
+    db.leaves.create_index(
+        [("user_id", 1), ("start_date", 1), ("end_date", 1)],
+        name="user_start_end",
+    )
+
+# Team reports match on start_date alone, without a user_id prefix
+def migrate_mongo_v2_start_date_index(db):
+    db.leaves.create_index([("start_date", 1), ("user_id", 1)], name="start_user")
+
+# Daily occupancy buckets: {_id: <date>, "off": {<user_id>: <overlapping leaves>}}
+def mongo_occupancy_updates(user_id, ranges, delta):
+    return [
+        UpdateOne({"_id": day}, {"$inc": {f"off.{user_id}": change}}, upsert=True)
+        for day, change in sorted(occupancy_changes(ranges, delta).items())
+    ]
+
+def rebuild_mongo_occupancy(db):
+    days = {}
+    projection = {"user_id": 1, "start_date": 1, "end_date": 1}
+    for leave in chain(db.leaves.find({}, projection=projection), db.leaves_archive.find({}, projection=projection)):
+        leave = leave_from_document(leave)
+        for day in iter_days(leave["start_date"], leave["end_date"]):
+            off = days.setdefault(day, {})
+            off[leave["user_id"]] = off.get(leave["user_id"], 0) + 1
+    db.occupancy.delete_many({})
+    if days:
+        db.occupancy.insert_many([{"_id": day, "off": off} for day, off in sorted(days.items())])
+
+# Seeds each user's ledger with their current balance as an opening grant
+def migrate_mongo_v4_ledger(db, batch_size=1000):
+    db.ledger.create_index([("user_id", 1), ("seq", 1)], unique=True, name="user_seq_unique")
+    db.balance_snapshots.create_index([("user_id", 1), ("seq", 1)], unique=True, name="user_seq_unique")
+    db.balance_snapshots.create_index([("user_id", 1), ("at", 1), ("seq", 1)], name="user_at_seq")
+    at = datetime.now().replace(microsecond=0)
+    cursor = db.settings.find({"ledger_seq": {"$exists": False}}, projection={"user_id": 1, "leave_balance": 1})
+    while batch := list(islice(cursor, batch_size)):
+        db.ledger.insert_many([
+            entry
+            for settings in batch
+            for entry in ledger_entries(settings["user_id"], [("grant", settings["leave_balance"], None)], 1, at)
+        ])
+        db.settings.bulk_write([
+            UpdateOne({"_id": settings["_id"]}, {"$set": {"ledger_seq": 1}}) for settings in batch
+        ])
+
+def migrate_mongo_v5_archive(db):
+    db.leaves_archive.create_index([("user_id", 1), ("start_date", 1)], name="user_start")
+    db.leaves_archive.create_index([("start_date", 1), ("user_id", 1)], name="start_user")
+    db.leave_year_summaries.create_index([("user_id", 1), ("year", 1)], unique=True, name="user_year_unique")
+
+MONGO_MIGRATIONS = [
+    (1, migrate_mongo_v1_indexes),
+    (2, migrate_mongo_v2_start_date_index),
+    (3, rebuild_mongo_occupancy),
+    (4, migrate_mongo_v4_ledger),
+    (5, migrate_mongo_v5_archive),
+]
+
+class MongoStorage(LeaveStorage):
+    name = "mongo"
+
+    def __init__(self, connection_string, database="leave_tracker", **pool_settings):
+        pool_settings = {**DEFAULT_POOL_SETTINGS, **pool_settings}
+        self.pool_listener = PoolStatsListener()
+        self.client = MongoClient(
+            connection_string,
+            maxPoolSize=pool_settings["max_pool_size"],
+            minPoolSize=pool_settings["min_pool_size"],
+            maxIdleTimeMS=pool_settings["max_idle_time_ms"],
+            connectTimeoutMS=pool_settings["connect_timeout_ms"],
+            serverSelectionTimeoutMS=pool_settings["server_selection_timeout_ms"],
+            waitQueueTimeoutMS=pool_settings["wait_queue_timeout_ms"],
+            event_listeners=[self.pool_listener],
+        )
+        self.db = self.client[database]
+        # Until every document is converted, queries match both storage formats
+        self.native_dates = False
+        # Re-read whenever the year list is served (archived_years, leave_years),
+        # so a year archived by another process shows up on the next page load
+        # without a round trip per query
+        self.archived = set()
+
+    def bootstrap(self):
+        meta = self.db.meta.find_one({"_id": "schema"}) or {}
+        current_version = meta.get("version", 0)
+        for version, migration in MONGO_MIGRATIONS:
+            if version > current_version:
+                migration(self.db)
+                self.db.meta.update_one(
+                    {"_id": "schema"},
+                    {"$set": {"version": version, "migrated_on": datetime.now()}},
+                    upsert=True
+                )
+                current_version = version
+        self.native_dates = self._native_types_complete()
+        self._load_archived()
+        return current_version
+
+    def _load_archived(self):
+        self.archived = set((self.db.meta.find_one({"_id": "archive"}) or {}).get("years", []))
+        return self.archived
+
+    def _native_types_complete(self):
+        if (self.db.meta.find_one({"_id": "native_types"}) or {}).get("complete"):
+            return True
+        # A database with nothing left to convert (e.g. a fresh one) needs no migration run
+        if self.db.leaves.find_one(LEGACY_LEAVE_FILTER, projection={"_id": 1}) is None \
+                and self.db.settings.find_one(LEGACY_SETTINGS_FILTER, projection={"_id": 1}) is None:
+            self._mark_native_types_complete()
+            return True
+        return False
+
+    def _mark_native_types_complete(self):
+        self.db.meta.update_one(
+            {"_id": "native_types"},
+            {"$set": {"complete": True, "completed_on": datetime.now()}},
+            upsert=True
+        )
+
+    # Batched, resumable conversion of legacy documents to native dates and
+    # doubles. Each batch only selects documents that still need converting and
+    # walks forward by _id, so an interrupted run picks up where it stopped.
+    # progress(collection, converted_so_far) is called after every batch.
+    def migrate_native_types(self, batch_size=1000, progress=None):
+        converted = {}
+        for collection, legacy_filter in (("leaves", LEGACY_LEAVE_FILTER), ("settings", LEGACY_SETTINGS_FILTER)):
+            converted[collection] = 0
+            last_id = None
+            while True:
+                query = legacy_filter if last_id is None else {"$and": [legacy_filter, {"_id": {"$gt": last_id}}]}
+                batch = list(self.db[collection].find(query).sort("_id", 1).limit(batch_size))
+                if not batch:
+                    break
+                if collection == "leaves":
+                    requests = [UpdateOne({"_id": doc["_id"]}, {"$set": native_leave_fields(doc)}) for doc in batch]
+                else:
+                    requests = [
+                        UpdateOne({"_id": doc["_id"]}, {"$set": {
+                            field: float(doc[field]) for field in SETTINGS_FIELDS
+                            if field in doc and not isinstance(doc[field], float)
+                        }})
+                        for doc in batch
+                    ]
+                self.db[collection].bulk_write(requests, ordered=False)
+                converted[collection] += len(batch)
+                last_id = batch[-1]["_id"]
+                if progress:
+                    progress(collection, converted[collection])
+
+        if self._native_types_complete():
+            self.native_dates = True
+        return converted
+
+    # Query clauses for date conditions such as ("start_date", "$lte", "2025-01-31"),
+    # one per storage format. BSON comparisons never cross types, so each clause
+    # only matches documents in its own format.
+    def _date_clauses(self, conditions=()):
+        native = {"start_date": {"$type": "date"}}
+        legacy = {"start_date": {"$type": "string"}}
+        for field, operator, value in conditions:
+            native.setdefault(field, {})[operator] = to_datetime(value)
+            legacy.setdefault(field, {})[operator] = value
+        return [native] if self.native_dates else [native, legacy]
+
+    def _match_dates(self, user_id, conditions=()):
+        clauses = self._date_clauses(conditions)
+        if len(clauses) == 1:
+            return {"user_id": str(user_id), **clauses[0]}
+        return {"user_id": str(user_id), "$or": clauses}
+
+    # Leaves sorted by start date. While both formats coexist each is queried
+    # separately (BSON sorts every string before every date) and the results
+    # are merged, which keeps the limit exact.
+    def _find_leaves(self, user_id, conditions=(), projection=None, limit=0):
+        clauses = self._date_clauses(conditions)
+        leaves = []
+        for clause in clauses:
+            cursor = self.db.leaves.find({"user_id": str(user_id), **clause}, projection=projection).sort("start_date", 1)
+            if limit:
+                cursor = cursor.limit(limit)
+            leaves.extend(leave_from_document(document) for document in cursor)
+        if len(clauses) > 1:
+            leaves.sort(key=lambda leave: leave["start_date"])
+            if limit:
+                leaves = leaves[:limit]
+        return leaves
+
+    def ping(self):
+        self.client.admin.command("ping")
+
+    def pool_stats(self):
+        return self.pool_listener.snapshot()
+
+    def create_user(self, username, password_hash):
+        try:
+            user_id = self.db.users.insert_one({
+                "username": username,
+                "password": password_hash
+            }).inserted_id
+        except DuplicateKeyError:
+            raise UsernameTakenError(username)
+
+        # Create default settings for the user
+        self._insert_default_settings(str(user_id))
+        return str(user_id)
+
+    # The default balance is the user's opening grant, inserted in one
+    # transaction with its ledger event
+    def _insert_default_settings(self, user_id):
+        def insert(session):
+            settings = {"user_id": user_id, **DEFAULT_SETTINGS, "ledger_seq": 1}
+            self.db.settings.insert_one(settings, session=session)
+            self._record_ledger(
+                user_id,
+                [("grant", DEFAULT_SETTINGS["leave_balance"], None)],
+                1,
+                DEFAULT_SETTINGS["leave_balance"],
+                session=session
+            )
+            return settings
+
+        with self.client.start_session() as session:
+            return session.with_transaction(insert)
+
+    def find_credentials(self, username):
+        user = self.db.users.find_one({"username": username}, projection={"_id": 1, "password": 1})
+        return (str(user['_id']), user['password']) if user else None
+
+    def set_password_hash(self, user_id, old_hash, new_hash):
+        return self.db.users.update_one(
+            {"_id": ObjectId(user_id), "password": old_hash},
+            {"$set": {"password": new_hash}}
+        ).modified_count == 1
+
+    def delete_user(self, user_id):
+        leaves = self._find_leaves(user_id, projection={"start_date": 1, "end_date": 1})
+        self.db.users.delete_one({"_id": ObjectId(user_id)})
+        self.db.settings.delete_many({"user_id": str(user_id)})
+        self.db.leaves.delete_many({"user_id": str(user_id)})
+        self.db.ledger.delete_many({"user_id": str(user_id)})
+        self.db.balance_snapshots.delete_many({"user_id": str(user_id)})
+        if self.archived:
+            leaves += map(leave_from_document, self.db.leaves_archive.find(
+                {"user_id": str(user_id)}, projection={"start_date": 1, "end_date": 1}
+            ))
+            self.db.leaves_archive.delete_many({"user_id": str(user_id)})
+            self.db.leave_year_summaries.delete_many({"user_id": str(user_id)})
+        self._update_occupancy(user_id, [(leave["start_date"], leave["end_date"]) for leave in leaves], -1)
+
+    def get_settings(self, user_id):
+        settings = self.db.settings.find_one({"user_id": str(user_id)})
+        if not settings:
+            # Create default settings if not found
+            try:
+                settings = self._insert_default_settings(str(user_id))
+            except DuplicateKeyError:
+                # Another session created the settings first
+                settings = self.db.settings.find_one({"user_id": str(user_id)})
+        return settings
+
+    def update_settings(self, user_id, updates):
+        check_settings_fields(updates)
+        if not updates:
+            return
+        fields = {field: float(value) for field, value in updates.items()}
+        if "leave_balance" not in fields:
+            self.db.settings.update_one({"user_id": str(user_id)}, {"$set": fields})
+            return
+
+        # A manual balance change is recorded as the difference from the balance
+        # it replaced, in the same transaction as the change
+        def adjust(session):
+            previous = self.db.settings.find_one_and_update(
+                {"user_id": str(user_id)},
+                {"$set": fields, "$inc": {"ledger_seq": 1}},
+                projection={"leave_balance": 1, "ledger_seq": 1},
+                return_document=ReturnDocument.BEFORE,
+                session=session
+            )
+            if previous is not None:
+                self._record_ledger(
+                    user_id,
+                    [("adjust", fields["leave_balance"] - float(previous["leave_balance"]), None)],
+                    previous.get("ledger_seq", 0) + 1,
+                    fields["leave_balance"],
+                    session=session
+                )
+
+        with self.client.start_session() as session:
+            session.with_transaction(adjust)
+
+    # Sorted by start date (earliest first); the sort is served by the user_start_end index
+    def list_leaves(self, user_id):
+        return self._find_leaves(user_id)
+
+    def iter_leaves(self, user_id, batch_size=EXPORT_BATCH_SIZE):
+        cursors = [
+            map(leave_from_document, self.db.leaves.find(
+                {"user_id": str(user_id), **clause},
+                projection={field: 1 for field in HISTORY_FIELDS},
+                batch_size=batch_size
+            ).sort("start_date", 1))
+            for clause in self._date_clauses(())
+        ]
+        if self.archived:
+            cursors.append(map(leave_from_document, self.db.leaves_archive.find(
+                {"user_id": str(user_id)},
+                projection={field: 1 for field in HISTORY_FIELDS},
+                batch_size=batch_size
+            ).sort("start_date", 1)))
+        return heapq.merge(*cursors, key=lambda leave: leave["start_date"])
+
+    def _year_conditions(self, year):
+        if year is None:
+            return ()
+        first_day, last_day = year_range(year)
+        return (("start_date", "$gte", first_day), ("start_date", "$lte", last_day))
+
+    # Archived leaves are always native, so one native clause matches them
+    def _archive_match(self, user_id, year):
+        first_day, last_day = year_range(year)
+        match = {"start_date": {"$gte": to_datetime(first_day), "$lte": to_datetime(last_day)}}
+        if user_id is not None:
+            match["user_id"] = str(user_id)
+        return match
+
+    # Pipeline stages adding the archived leaves of year, if it is archived,
+    # passed through any extra stages
+    def _with_archive(self, user_id, year, *stages):
+        if year not in self.archived:
+            return []
+        return [{"$unionWith": {
+            "coll": "leaves_archive",
+            "pipeline": [{"$match": self._archive_match(user_id, year)}, *stages]
+        }}]
+
+    # Served by the user_start_end index: equality on user_id, range and sort on start_date
+    def list_leaves_page(self, user_id, year=None, limit=HISTORY_PAGE_SIZE):
+        if year in self.archived:
+            leaves = [
+                leave_from_document(leave)
+                for leave in self.db.leaves.aggregate([
+                    {"$match": self._match_dates(user_id, self._year_conditions(year))},
+                    {"$set": {"archived": False}},
+                    *self._with_archive(user_id, year, {"$set": {"archived": True}}),
+                    {"$set": {"start_date": {"$toDate": "$start_date"}, "end_date": {"$toDate": "$end_date"}}},
+                    {"$sort": {"start_date": 1}},
+                    {"$limit": limit + 1},
+                    {"$project": {field: 1 for field in (*HISTORY_FIELDS, "archived")}},
+                ])
+            ]
+            return leaves[:limit], len(leaves) > limit
+        leaves = self._find_leaves(
+            user_id,
+            self._year_conditions(year),
+            projection={field: 1 for field in HISTORY_FIELDS},
+            limit=limit + 1
+        )
+        return leaves[:limit], len(leaves) > limit
+
+    def leave_years(self, user_id):
+        years = self.db.leaves.aggregate([
+            {"$match": {"user_id": str(user_id)}},
+            # $toDate passes native dates through and parses legacy YYYY-MM-DD strings
+            {"$group": {"_id": {"$year": {"$toDate": "$start_date"}}}},
+            {"$sort": {"_id": -1}}
+        ])
+        years = {int(year["_id"]) for year in years}
+        if self._load_archived():
+            years |= {summary["year"] for summary in self.year_summaries(user_id) if summary["count"]}
+        return sorted(years, reverse=True)
+
+    def leave_totals(self, user_id, year):
+        totals = list(self.db.leaves.aggregate([
+            {"$match": self._match_dates(user_id, self._year_conditions(year))},
+            *self._with_archive(user_id, year),
+            {"$group": {"_id": None, "hours": {"$sum": "$hours"}, "count": {"$sum": 1}}}
+        ]))
+        if not totals:
+            return {"hours": 0.0, "count": 0}
+        return {"hours": float(totals[0]["hours"]), "count": totals[0]["count"]}
+
+    def usage_by_month(self, user_id, year):
+        months = self.db.leaves.aggregate([
+            {"$match": self._match_dates(user_id, self._year_conditions(year))},
+            *self._with_archive(user_id, year),
+            {"$group": {
+                "_id": {"$month": {"$toDate": "$start_date"}},
+                "hours": {"$sum": "$hours"},
+                "count": {"$sum": 1}
+            }},
+            {"$sort": {"_id": 1}}
+        ])
+        return [{"month": month["_id"], "hours": float(month["hours"]), "count": month["count"]} for month in months]
+
+    def usage_by_year(self, user_id):
+        years = self.db.leaves.aggregate([
+            {"$match": {"user_id": str(user_id)}},
+            {"$group": {
+                "_id": {"$year": {"$toDate": "$start_date"}},
+                "hours": {"$sum": "$hours"},
+                "count": {"$sum": 1}
+            }},
+            {"$sort": {"_id": 1}}
+        ])
+        usage = [{"year": year["_id"], "hours": float(year["hours"]), "count": year["count"]} for year in years]
+        return merge_year_summaries(usage, self.year_summaries(user_id)) if self.archived else usage
+
+    # Same clauses as _match_dates but across all users, served by the start_user index
+    def _match_year(self, year):
+        clauses = self._date_clauses(self._year_conditions(year))
+        return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+    def team_usage(self, year):
+        usage = list(self.db.leaves.aggregate([
+            {"$match": self._match_year(year)},
+            *self._with_archive(None, year),
+            {"$group": {"_id": "$user_id", "hours": {"$sum": "$hours"}, "count": {"$sum": 1}}},
+            {"$sort": {"hours": -1}}
+        ]))
+        usernames = {
+            str(user["_id"]): user["username"]
+            for user in self.db.users.find(
+                {"_id": {"$in": [ObjectId(row["_id"]) for row in usage if ObjectId.is_valid(row["_id"])]}},
+                projection={"username": 1}
+            )
+        }
+        return [
+            {"user_id": row["_id"], "username": usernames.get(row["_id"], row["_id"]), "hours": float(row["hours"]), "count": row["count"]}
+            for row in usage
+        ]
+
+    def team_hours_distribution(self, year):
+        buckets = {
+            bucket["_id"]: bucket["users"]
+            for bucket in self.db.leaves.aggregate([
+                {"$match": self._match_year(year)},
+                *self._with_archive(None, year),
+                {"$group": {"_id": "$user_id", "hours": {"$sum": "$hours"}}},
+                {"$bucket": {
+                    "groupBy": "$hours",
+                    "boundaries": TEAM_HOURS_BUCKETS,
+                    "default": "other",
+                    "output": {"users": {"$sum": 1}}
+                }}
+            ])
+        }
+        return [
+            {"min_hours": low, "max_hours": high, "users": buckets.get(low, 0)}
+            for low, high in zip(TEAM_HOURS_BUCKETS, TEAM_HOURS_BUCKETS[1:])
+        ]
+
+    # One indexed range read on _id, however many people are in the team
+    def team_calendar(self, start_date, end_date):
+        days = self.db.occupancy.find(
+            {"_id": {"$gte": to_datetime(start_date), "$lte": to_datetime(end_date)}}
+        ).sort("_id", 1)
+        calendar = []
+        for day in days:
+            user_ids = sorted(user_id for user_id, count in day.get("off", {}).items() if count > 0)
+            if user_ids:
+                calendar.append({"date": day["_id"].strftime(DATE_FORMAT), "user_ids": user_ids})
+        return calendar
+
+    def rebuild_occupancy(self):
+        rebuild_mongo_occupancy(self.db)
+
+    def get_usernames(self, user_ids):
+        object_ids = [ObjectId(user_id) for user_id in user_ids if ObjectId.is_valid(user_id)]
+        return {
+            str(user["_id"]): user["username"]
+            for user in self.db.users.find({"_id": {"$in": object_ids}}, projection={"username": 1})
+        }
+
+    # start_date <= end_date AND end_date >= start_date, answered by the user_start_end index
+    def find_overlaps(self, user_id, start_date, end_date, limit=1):
+        return self._find_leaves(
+            user_id,
+            (("start_date", "$lte", end_date), ("end_date", "$gte", start_date)),
+            projection={"_id": 1, "start_date": 1, "end_date": 1},
+            limit=limit
+        )
+
+    # The balance is decremented with a guarded $inc so two tabs can never
+    # overspend it, in one transaction with the insert, occupancy and ledger
+    # writes so a failure never leaves the balance deducted without its
+    # booking. Returns None if the balance does not cover the hours.
+    def book_leave(self, user_id, start_date, end_date, hours):
+        hours = float(hours)
+
+        def book(session):
+            settings = self.db.settings.find_one_and_update(
+                {"user_id": str(user_id), "leave_balance": {"$gte": hours}},
+                {"$inc": {"leave_balance": -hours, "ledger_seq": 1}},
+                projection={"leave_balance": 1, "ledger_seq": 1},
+                return_document=ReturnDocument.AFTER,
+                session=session
+            )
+            if settings is None:
+                return None
+            leave_id = self.db.leaves.insert_one(
+                {
+                    "user_id": str(user_id),
+                    "start_date": to_datetime(start_date),
+                    "end_date": to_datetime(end_date),
+                    "hours": hours,
+                    "requested_on": datetime.now().replace(microsecond=0)
+                },
+                session=session
+            ).inserted_id
+            self._update_occupancy(user_id, [(start_date, end_date)], 1, session=session)
+            self._record_ledger(
+                user_id,
+                [("booking", -hours, leave_id)],
+                settings["ledger_seq"],
+                settings["leave_balance"],
+                session=session
+            )
+            return settings["leave_balance"]
+
+        with self.client.start_session() as session:
+            return session.with_transaction(book)
+
+    # Appends events ending at last_seq, whose balance afterwards is balance
+    def _record_ledger(self, user_id, events, last_seq, balance, session=None):
+        if not events:
+            return
+        at = datetime.now().replace(microsecond=0)
+        self.db.ledger.insert_many(ledger_entries(user_id, events, last_seq, at), session=session)
+        if snapshot_due(last_seq, len(events)):
+            self.db.balance_snapshots.update_one(
+                {"user_id": str(user_id), "seq": last_seq},
+                {"$set": {"at": at, "balance": float(balance)}},
+                upsert=True,
+                session=session
+            )
+
+    def _update_occupancy(self, user_id, ranges, delta, session=None):
+        updates = mongo_occupancy_updates(user_id, ranges, delta)
+        if updates:
+            self.db.occupancy.bulk_write(updates, ordered=False, session=session)
+
+    # One transaction, so a failed insert never leaves the balance deducted
+    def import_leaves(self, user_id, leaves):
+        total_hours = sum(float(leave["hours"]) for leave in leaves)
+
+        def import_all(session):
+            settings = self.db.settings.find_one_and_update(
+                {"user_id": str(user_id), "leave_balance": {"$gte": total_hours}},
+                {"$inc": {"leave_balance": -total_hours, "ledger_seq": len(leaves)}},
+                projection={"leave_balance": 1, "ledger_seq": 1},
+                return_document=ReturnDocument.AFTER,
+                session=session
+            )
+            if settings is None:
+                return None
+            requested_on = datetime.now().replace(microsecond=0)
+            leave_ids = self.db.leaves.insert_many(
+                [
+                    {
+                        "user_id": str(user_id),
+                        "start_date": to_datetime(leave["start_date"]),
+                        "end_date": to_datetime(leave["end_date"]),
+                        "hours": float(leave["hours"]),
+                        "requested_on": requested_on
+                    }
+                    for leave in leaves
+                ],
+                session=session
+            ).inserted_ids
+            self._update_occupancy(
+                user_id, [(leave["start_date"], leave["end_date"]) for leave in leaves], 1, session=session
+            )
+            self._record_ledger(
+                user_id,
+                [("booking", -float(leave["hours"]), leave_id) for leave, leave_id in zip(leaves, leave_ids)],
+                settings["ledger_seq"],
+                settings["leave_balance"],
+                session=session
+            )
+            return settings["leave_balance"]
+
+        with self.client.start_session() as session:
+            return session.with_transaction(import_all)
+
+    # The delete happens first, so a leave removed concurrently from another
+    # tab is never refunded twice, and in one transaction with the refund, so a
+    # failure in between never loses the hours. Returns None if the leave no longer exists.
+    def cancel_leave(self, user_id, leave_id):
+        def delete_and_refund(session):
+            leave = self.db.leaves.find_one_and_delete(
+                {"_id": ObjectId(leave_id), "user_id": str(user_id)},
+                projection={"hours": 1, "start_date": 1, "end_date": 1},
+                session=session
+            )
+            if leave is None:
+                return None
+            leave = leave_from_document(leave)
+            self._update_occupancy(user_id, [(leave["start_date"], leave["end_date"])], -1, session=session)
+            settings = self.db.settings.find_one_and_update(
+                {"user_id": str(user_id)},
+                {"$inc": {"leave_balance": leave['hours'], "ledger_seq": 1}},
+                projection={"leave_balance": 1, "ledger_seq": 1},
+                return_document=ReturnDocument.AFTER,
+                session=session
+            )
+            self._record_ledger(
+                user_id,
+                [("refund", leave['hours'], leave['_id'])],
+                settings["ledger_seq"],
+                settings["leave_balance"],
+                session=session
+            )
+            return settings["leave_balance"]
+
+        with self.client.start_session() as session:
+            return session.with_transaction(delete_and_refund)
+
+    # Deletes and refunds in a transaction so the refund always matches exactly
+    # the documents that were removed
+    def _delete_and_refund(self, user_id, query):
+        def delete_and_refund(session):
+            leaves = [
+                leave_from_document(leave)
+                for leave in self.db.leaves.find(query, projection={"hours": 1, "start_date": 1, "end_date": 1}, session=session)
+            ]
+            total_hours = sum(leave['hours'] for leave in leaves)
+            self.db.leaves.delete_many({"_id": {"$in": [leave['_id'] for leave in leaves]}}, session=session)
+            self._update_occupancy(
+                user_id, [(leave["start_date"], leave["end_date"]) for leave in leaves], -1, session=session
+            )
+            settings = self.db.settings.find_one_and_update(
+                {"user_id": str(user_id)},
+                {"$inc": {"leave_balance": total_hours, "ledger_seq": len(leaves)}},
+                projection={"leave_balance": 1, "ledger_seq": 1},
+                return_document=ReturnDocument.AFTER,
+                session=session
+            )
+            self._record_ledger(
+                user_id,
+                [("refund", leave['hours'], leave['_id']) for leave in leaves],
+                settings["ledger_seq"],
+                settings["leave_balance"],
+                session=session
+            )
+            return settings["leave_balance"]
+
+        with self.client.start_session() as session:
+            return session.with_transaction(delete_and_refund)
+
+    def cancel_leaves(self, user_id, leave_ids):
+        return self._delete_and_refund(user_id, {
+            "_id": {"$in": [ObjectId(leave_id) for leave_id in leave_ids]},
+            "user_id": str(user_id)
+        })
+
+    def cancel_all_leaves(self, user_id):
+        return self._delete_and_refund(user_id, {"user_id": str(user_id)})
+
+    def ledger_events(self, user_id, limit=LEDGER_PAGE_SIZE):
+        events = self.db.ledger.find(
+            {"user_id": str(user_id)},
+            projection={"_id": 0, "seq": 1, "at": 1, "kind": 1, "hours": 1, "leave_id": 1}
+        ).sort("seq", -1).limit(limit)
+        return [{**event, "at": event["at"].strftime(TIMESTAMP_FORMAT)} for event in events]
+
+    def _latest_snapshot(self, user_id, cutoff=None, session=None):
+        if cutoff is None:
+            query, sort = {"user_id": str(user_id)}, [("seq", -1)]
+        else:
+            query, sort = {"user_id": str(user_id), "at": {"$lt": cutoff}}, [("at", -1), ("seq", -1)]
+        snapshot = self.db.balance_snapshots.find_one(query, sort=sort, session=session)
+        return (snapshot["seq"], snapshot["balance"]) if snapshot else (0, 0.0)
+
+    def _first_ledger_event(self, user_id):
+        return self.db.ledger.find_one({"user_id": str(user_id)}, projection={"_id": 0, "at": 1}, sort=[("seq", 1)])
+
+    def ledger_start(self, user_id):
+        first = self._first_ledger_event(user_id)
+        return first["at"].strftime(TIMESTAMP_FORMAT) if first else None
+
+    def balance_as_of(self, user_id, as_of=None):
+        cutoff = ledger_cutoff(as_of)
+        if cutoff is not None:
+            first = self._first_ledger_event(user_id)
+            if first is None or first["at"] >= cutoff:
+                return None
+        base_seq, balance = self._latest_snapshot(user_id, cutoff)
+        match = {"user_id": str(user_id), "seq": {"$gt": base_seq}}
+        if cutoff is not None:
+            match["at"] = {"$lt": cutoff}
+        delta = list(self.db.ledger.aggregate([
+            {"$match": match},
+            {"$group": {"_id": None, "hours": {"$sum": "$hours"}}},
+        ]))
+        return balance + (delta[0]["hours"] if delta else 0.0)
+
+    def rebuild_balance(self, user_id, from_seq=None):
+        def rebuild(session):
+            if from_seq is not None:
+                self.db.balance_snapshots.delete_many(
+                    {"user_id": str(user_id), "seq": {"$gte": from_seq}}, session=session
+                )
+            base_seq, balance = self._latest_snapshot(user_id, session=session)
+            events = self.db.ledger.find(
+                {"user_id": str(user_id), "seq": {"$gt": base_seq}},
+                projection={"seq": 1, "at": 1, "hours": 1},
+                session=session
+            ).sort("seq", 1)
+            balance, snapshots = replay_ledger(
+                base_seq, balance, ((event["seq"], event["at"], event["hours"]) for event in events)
+            )
+            if snapshots:
+                self.db.balance_snapshots.insert_many(
+                    [{"user_id": str(user_id), "seq": seq, "at": at, "balance": value} for seq, at, value in snapshots],
+                    session=session
+                )
+            self.db.settings.update_one(
+                {"user_id": str(user_id)}, {"$set": {"leave_balance": balance}}, session=session
+            )
+            return balance
+
+        with self.client.start_session() as session:
+            return session.with_transaction(rebuild)
+
+    def archived_years(self):
+        return sorted(self._load_archived())
+
+    def archive_year(self, year, carry_over_limit=None):
+        year = int(year)
+        if year >= date.today().year:
+            raise ValueError(f"{year} is not over yet and cannot be archived")
+        # Marked first: readers union both partitions for the year while leaves move
+        self.db.meta.update_one({"_id": "archive"}, {"$addToSet": {"years": year}}, upsert=True)
+        self.archived.add(year)
+
+        return count_archived(
+            self._archive_user_year(settings["user_id"], year, carry_over_limit)
+            for settings in self.db.settings.find({}, projection={"user_id": 1})
+        )
+
+    # Moves one user's leaves for the year and writes their summary in one
+    # transaction. Returns (leaves moved, closing balance), or None if already archived.
+    def _archive_user_year(self, user_id, year, carry_over_limit):
+        if self.db.leave_year_summaries.find_one({"user_id": user_id, "year": year}, projection={"_id": 1}):
+            return None
+        first_day, last_day = year_range(year)
+        closing_balance = self.balance_as_of(user_id, last_day)
+
+        def archive(session):
+            # Leaves running into the next year stay active for its overlap checks
+            leaves = [
+                {**leave, **native_leave_fields(leave)}
+                for leave in self.db.leaves.find(
+                    self._match_dates(user_id, (
+                        ("start_date", "$gte", first_day),
+                        ("start_date", "$lte", last_day),
+                        ("end_date", "$lte", last_day),
+                    )),
+                    session=session
+                )
+            ]
+            if leaves:
+                self.db.leaves_archive.insert_many(leaves, session=session)
+                self.db.leaves.delete_many({"_id": {"$in": [leave["_id"] for leave in leaves]}}, session=session)
+
+            current = self.db.settings.find_one({"user_id": user_id}, projection={"leave_balance": 1}, session=session)
+            carried_over, forfeited = carry_over(closing_balance, float(current["leave_balance"]), carry_over_limit)
+            if forfeited:
+                settings = self.db.settings.find_one_and_update(
+                    {"user_id": user_id},
+                    {"$inc": {"leave_balance": -forfeited, "ledger_seq": 1}},
+                    projection={"leave_balance": 1, "ledger_seq": 1},
+                    return_document=ReturnDocument.AFTER,
+                    session=session
+                )
+                self._record_ledger(
+                    user_id, [("adjust", -forfeited, None)], settings["ledger_seq"], settings["leave_balance"], session=session
+                )
+            self.db.leave_year_summaries.insert_one({
+                "user_id": user_id,
+                "year": year,
+                "hours": sum(float(leave["hours"]) for leave in leaves),
+                "count": len(leaves),
+                "closing_balance": closing_balance,
+                "carried_over": carried_over,
+                "forfeited": forfeited,
+                "archived_on": datetime.now().replace(microsecond=0),
+            }, session=session)
+            return len(leaves), closing_balance
+
+        with self.client.start_session() as session:
+            return session.with_transaction(archive)
+
+    def year_summaries(self, user_id):
+        summaries = self.db.leave_year_summaries.find(
+            {"user_id": str(user_id)}, projection={"_id": 0, "user_id": 0}
+        ).sort("year", 1)
+        return [{**summary, "archived_on": summary["archived_on"].strftime(TIMESTAMP_FORMAT)} for summary in summaries]
+
+# SQLite schema migrations for the local backend, mirroring MONGO_MIGRATIONS
+def migrate_local_v1_tables(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL UNIQUE,
+            password TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS settings (
+            user_id TEXT PRIMARY KEY,
+            mon_hours REAL NOT NULL,
+            tue_hours REAL NOT NULL,
+            wed_hours REAL NOT NULL,
+            thu_hours REAL NOT NULL,
+            fri_hours REAL NOT NULL,
+            sat_hours REAL NOT NULL,
+            sun_hours REAL NOT NULL,
+            leave_balance REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS leaves (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            start_date TEXT NOT NULL,
+            end_date TEXT NOT NULL,
+            hours REAL NOT NULL,
+            requested_on TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS user_start_end ON leaves (user_id, start_date, end_date);
+    """)
+
+def migrate_local_v2_start_date_index(conn):
+    conn.executescript("CREATE INDEX IF NOT EXISTS start_user ON leaves (start_date, user_id);")
+
+def migrate_local_v3_occupancy(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS occupancy (
+            day TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            leaves INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID;
+    """)
+    rebuild_local_occupancy(conn)
+
+# Per-day occupancy rows: one per (day, user) with the number of overlapping leaves
+def update_local_occupancy(conn, user_id, ranges, delta):
+    conn.executemany(
+        "INSERT INTO occupancy (day, user_id, leaves) VALUES (?, ?, ?) "
+        "ON CONFLICT (day, user_id) DO UPDATE SET leaves = leaves + excluded.leaves",
+        [
+            (day.strftime(DATE_FORMAT), str(user_id), change)
+            for day, change in sorted(occupancy_changes(ranges, delta).items())
+        ]
+    )
+    conn.execute("DELETE FROM occupancy WHERE leaves <= 0")
+
+def rebuild_local_occupancy(conn):
+    conn.execute("DELETE FROM occupancy")
+    source = "leaves"
+    # The archive only exists from schema version 5
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'leaves_archive'").fetchone():
+        source = "(SELECT user_id, start_date, end_date FROM leaves UNION ALL SELECT user_id, start_date, end_date FROM leaves_archive)"
+    leaves_by_user = {}
+    for user_id, start_date, end_date in conn.execute(f"SELECT user_id, start_date, end_date FROM {source}"):
+        leaves_by_user.setdefault(user_id, []).append((start_date, end_date))
+    for user_id, ranges in leaves_by_user.items():
+        update_local_occupancy(conn, user_id, ranges, 1)
+
+# Seeds each user's ledger with their current balance as an opening grant
+def migrate_local_v4_ledger(conn):
+    conn.executescript("""
+        BEGIN;
+        ALTER TABLE settings ADD COLUMN ledger_seq INTEGER NOT NULL DEFAULT 0;
+        CREATE TABLE IF NOT EXISTS ledger (
+            user_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            at TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            hours REAL NOT NULL,
+            leave_id TEXT,
+            PRIMARY KEY (user_id, seq)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS balance_snapshots (
+            user_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            at TEXT NOT NULL,
+            balance REAL NOT NULL,
+            PRIMARY KEY (user_id, seq)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS balance_snapshots_user_at ON balance_snapshots (user_id, at, seq);
+        INSERT INTO ledger (user_id, seq, at, kind, hours)
+            SELECT user_id, 1, strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime'), 'grant', leave_balance FROM settings;
+        UPDATE settings SET ledger_seq = 1;
+        COMMIT;
+    """)
+
+# Appends events after the balance update they describe, in the same transaction
+def record_local_ledger(conn, user_id, events):
+    if not events:
+        return
+    conn.execute("UPDATE settings SET ledger_seq = ledger_seq + ? WHERE user_id = ?", (len(events), str(user_id)))
+    last_seq, balance = conn.execute(
+        "SELECT ledger_seq, leave_balance FROM settings WHERE user_id = ?", (str(user_id),)
+    ).fetchone()
+    at = requested_on_now()
+    conn.executemany(
+        "INSERT INTO ledger (user_id, seq, at, kind, hours, leave_id) "
+        "VALUES (:user_id, :seq, :at, :kind, :hours, :leave_id)",
+        ledger_entries(user_id, events, last_seq, at)
+    )
+    if snapshot_due(last_seq, len(events)):
+        conn.execute(
+            "INSERT OR REPLACE INTO balance_snapshots (user_id, seq, at, balance) VALUES (?, ?, ?, ?)",
+            (str(user_id), last_seq, at, balance)
+        )
+
+def migrate_local_v5_archive(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS leaves_archive (
+            id INTEGER PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            start_date TEXT NOT NULL,
+            end_date TEXT NOT NULL,
+            hours REAL NOT NULL,
+            requested_on TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS archive_user_start ON leaves_archive (user_id, start_date);
+        CREATE INDEX IF NOT EXISTS archive_start_user ON leaves_archive (start_date, user_id);
+        CREATE TABLE IF NOT EXISTS leave_year_summaries (
+            user_id TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            hours REAL NOT NULL,
+            count INTEGER NOT NULL,
+            closing_balance REAL NOT NULL,
+            carried_over REAL NOT NULL,
+            forfeited REAL NOT NULL,
+            archived_on TEXT NOT NULL,
+            PRIMARY KEY (user_id, year)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS archived_years (year INTEGER PRIMARY KEY);
+    """)
+
+# Closing balances are unknown for users whose ledger starts after the archived
+# year. MongoDB stores those summaries with nulls and needs no migration.
+def migrate_local_v6_nullable_closing_balance(conn):
+    conn.executescript("""
+        BEGIN;
+        CREATE TABLE leave_year_summaries_v6 (
+            user_id TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            hours REAL NOT NULL,
+            count INTEGER NOT NULL,
+            closing_balance REAL,
+            carried_over REAL,
+            forfeited REAL NOT NULL,
+            archived_on TEXT NOT NULL,
+            PRIMARY KEY (user_id, year)
+        ) WITHOUT ROWID;
+        INSERT INTO leave_year_summaries_v6
+            SELECT user_id, year, hours, count, closing_balance, carried_over, forfeited, archived_on
+            FROM leave_year_summaries;
+        DROP TABLE leave_year_summaries;
+        ALTER TABLE leave_year_summaries_v6 RENAME TO leave_year_summaries;
+        COMMIT;
+    """)
+
+LOCAL_MIGRATIONS = [
+    (1, migrate_local_v1_tables),
+    (2, migrate_local_v2_start_date_index),
+    (3, migrate_local_v3_occupancy),
+    (4, migrate_local_v4_ledger),
+    (5, migrate_local_v5_archive),
+    (6, migrate_local_v6_nullable_closing_balance),
+]
+
+LEAVE_COLUMNS = "id AS _id, user_id, start_date, end_date, hours, requested_on"
+
+# Local stand-in for MongoStorage backed by SQLite (":memory:" for a throwaway
+# in-process database). One connection is shared and serialised by a lock;
+# every write runs in a single SQLite transaction.
+class LocalStorage(LeaveStorage):
+    name = "local"
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        if path != ":memory:":
+            self.conn.execute("PRAGMA journal_mode=WAL")
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return [dict(row) for row in self.conn.execute(sql, params)]
+
+    def _query_one(self, sql, params=()):
+        rows = self._query(sql, params)
+        return rows[0] if rows else None
+
+    # BEGIN IMMEDIATE takes the write lock up front, like a Mongo single-document update
+    def _transaction(self, work):
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = work(self.conn)
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            return result
+
+    def bootstrap(self):
+        def migrate(conn):
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            row = conn.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+            return int(row[0]) if row else 0
+
+        with self._lock:
+            current_version = self._transaction(migrate)
+            for version, migration in LOCAL_MIGRATIONS:
+                if version > current_version:
+                    # executescript commits on its own, so migrations run outside _transaction
+                    migration(self.conn)
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO meta (key, value) VALUES ('schema_version', ?)",
+                        (str(version),)
+                    )
+                    current_version = version
+        return current_version
+
+    def ping(self):
+        self._query("SELECT 1")
+
+    def create_user(self, username, password_hash):
+        def insert(conn):
+            try:
+                user_id = str(conn.execute(
+                    "INSERT INTO users (username, password) VALUES (?, ?)",
+                    (username, password_hash)
+                ).lastrowid)
+            except sqlite3.IntegrityError:
+                raise UsernameTakenError(username)
+            self._insert_default_settings(conn, user_id)
+            return user_id
+
+        return self._transaction(insert)
+
+    def _insert_default_settings(self, conn, user_id):
+        columns = ", ".join(SETTINGS_FIELDS)
+        placeholders = ", ".join("?" for _ in SETTINGS_FIELDS)
+        inserted = conn.execute(
+            f"INSERT OR IGNORE INTO settings (user_id, {columns}) VALUES (?, {placeholders})",
+            (user_id, *DEFAULT_SETTINGS.values())
+        ).rowcount
+        # The default balance is the user's opening grant
+        if inserted:
+            record_local_ledger(conn, user_id, [("grant", DEFAULT_SETTINGS["leave_balance"], None)])
+
+    def find_credentials(self, username):
+        user = self._query_one("SELECT id, password FROM users WHERE username = ?", (username,))
+        return (str(user['id']), user['password']) if user else None
+
+    def set_password_hash(self, user_id, old_hash, new_hash):
+        return self._transaction(lambda conn: conn.execute(
+            "UPDATE users SET password = ? WHERE id = ? AND password = ?",
+            (new_hash, int(user_id), old_hash)
+        ).rowcount == 1)
+
+    def delete_user(self, user_id):
+        def delete(conn):
+            leaves = conn.execute("SELECT start_date, end_date FROM leaves WHERE user_id = ?", (str(user_id),)).fetchall()
+            conn.execute("DELETE FROM users WHERE id = ?", (int(user_id),))
+            conn.execute("DELETE FROM settings WHERE user_id = ?", (str(user_id),))
+            conn.execute("DELETE FROM leaves WHERE user_id = ?", (str(user_id),))
+            conn.execute("DELETE FROM ledger WHERE user_id = ?", (str(user_id),))
+            conn.execute("DELETE FROM balance_snapshots WHERE user_id = ?", (str(user_id),))
+            leaves += conn.execute(
+                "SELECT start_date, end_date FROM leaves_archive WHERE user_id = ?", (str(user_id),)
+            ).fetchall()
+            conn.execute("DELETE FROM leaves_archive WHERE user_id = ?", (str(user_id),))
+            conn.execute("DELETE FROM leave_year_summaries WHERE user_id = ?", (str(user_id),))
+            update_local_occupancy(conn, user_id, [tuple(leave) for leave in leaves], -1)
+
+        self._transaction(delete)
+
+    def get_settings(self, user_id):
+        settings = self._query_one("SELECT * FROM settings WHERE user_id = ?", (str(user_id),))
+        if not settings:
+            self._transaction(lambda conn: self._insert_default_settings(conn, str(user_id)))
+            settings = self._query_one("SELECT * FROM settings WHERE user_id = ?", (str(user_id),))
+        return settings
+
+    def update_settings(self, user_id, updates):
+        check_settings_fields(updates)
+        if not updates:
+            return
+        assignments = ", ".join(f"{field} = ?" for field in updates)
+
+        def update(conn):
+            previous = conn.execute("SELECT leave_balance FROM settings WHERE user_id = ?", (str(user_id),)).fetchone()
+            conn.execute(
+                f"UPDATE settings SET {assignments} WHERE user_id = ?",
+                (*(float(value) for value in updates.values()), str(user_id))
+            )
+            # A manual balance change is recorded as the difference from the balance it replaced
+            if "leave_balance" in updates and previous is not None:
+                record_local_ledger(conn, user_id, [("adjust", float(updates["leave_balance"]) - previous[0], None)])
+
+        self._transaction(update)
+
+    def list_leaves(self, user_id):
+        return self._query(
+            f"SELECT {LEAVE_COLUMNS} FROM leaves WHERE user_id = ? ORDER BY start_date",
+            (str(user_id),)
+        )
+
+    # Keyset pages on (start_date, id), so the shared connection is never held
+    # between batches
+    def iter_leaves(self, user_id, batch_size=EXPORT_BATCH_SIZE):
+        source = self._leaves_source(archived=bool(self.archived_years()))
+        after = ("", 0)
+        while True:
+            leaves = self._query(
+                f"SELECT {LEAVE_COLUMNS} FROM {source} WHERE user_id = ? AND (start_date, id) > (?, ?) "
+                "ORDER BY start_date, id LIMIT ?",
+                (str(user_id), *after, batch_size)
+            )
+            yield from leaves
+            if len(leaves) < batch_size:
+                return
+            after = (leaves[-1]["start_date"], leaves[-1]["_id"])
+
+    # Archived years read the active and archived partitions together
+    def _leaves_source(self, year=None, archived=None):
+        if archived is None:
+            archived = year is not None and year in self.archived_years()
+        if not archived:
+            return "leaves"
+        return "(SELECT * FROM leaves UNION ALL SELECT * FROM leaves_archive)"
+
+    def _leaves_where(self, user_id, year=None):
+        where, params = "user_id = ?", (str(user_id),)
+        if year is not None:
+            where += " AND start_date BETWEEN ? AND ?"
+            params += year_range(year)
+        return where, params
+
+    def list_leaves_page(self, user_id, year=None, limit=HISTORY_PAGE_SIZE):
+        where, params = self._leaves_where(user_id, year)
+        if self._leaves_source(year) == "leaves":
+            leaves = self._query(
+                f"SELECT {LEAVE_COLUMNS} FROM leaves WHERE {where} ORDER BY start_date LIMIT ?",
+                params + (limit + 1,)
+            )
+        else:
+            leaves = [
+                {**leave, "archived": bool(leave["archived"])}
+                for leave in self._query(
+                    f"SELECT {LEAVE_COLUMNS}, 0 AS archived FROM leaves WHERE {where} "
+                    f"UNION ALL SELECT {LEAVE_COLUMNS}, 1 AS archived FROM leaves_archive WHERE {where} "
+                    "ORDER BY start_date LIMIT ?",
+                    params + params + (limit + 1,)
+                )
+            ]
+        return leaves[:limit], len(leaves) > limit
+
+    def leave_years(self, user_id):
+        rows = self._query(
+            "SELECT DISTINCT CAST(substr(start_date, 1, 4) AS INTEGER) AS year FROM leaves WHERE user_id = ? "
+            "UNION SELECT year FROM leave_year_summaries WHERE user_id = ? AND count > 0 "
+            "ORDER BY year DESC",
+            (str(user_id), str(user_id))
+        )
+        return [int(row["year"]) for row in rows]
+
+    def leave_totals(self, user_id, year):
+        where, params = self._leaves_where(user_id, year)
+        return self._query_one(
+            f"SELECT COALESCE(SUM(hours), 0.0) AS hours, COUNT(*) AS count FROM {self._leaves_source(year)} WHERE {where}",
+            params
+        )
+
+    def usage_by_month(self, user_id, year):
+        where, params = self._leaves_where(user_id, year)
+        return self._query(
+            f"SELECT CAST(substr(start_date, 6, 2) AS INTEGER) AS month, SUM(hours) AS hours, COUNT(*) AS count "
+            f"FROM {self._leaves_source(year)} WHERE {where} GROUP BY month ORDER BY month",
+            params
+        )
+
+    def usage_by_year(self, user_id):
+        usage = self._query(
+            "SELECT CAST(substr(start_date, 1, 4) AS INTEGER) AS year, SUM(hours) AS hours, COUNT(*) AS count "
+            "FROM leaves WHERE user_id = ? GROUP BY year ORDER BY year",
+            (str(user_id),)
+        )
+        return merge_year_summaries(usage, self.year_summaries(user_id))
+
+    def team_usage(self, year):
+        return self._query(
+            "SELECT leaves.user_id, COALESCE(users.username, leaves.user_id) AS username, "
+            "SUM(leaves.hours) AS hours, COUNT(*) AS count "
+            f"FROM {self._leaves_source(year)} AS leaves LEFT JOIN users ON users.id = CAST(leaves.user_id AS INTEGER) "
+            "WHERE leaves.start_date BETWEEN ? AND ? "
+            "GROUP BY leaves.user_id ORDER BY hours DESC",
+            year_range(year)
+        )
+
+    # SQLite has no $bucket; the grouped rows (one per user) are bucketed here
+    def team_hours_distribution(self, year):
+        counts = [0] * (len(TEAM_HOURS_BUCKETS) - 1)
+        for row in self.team_usage(year):
+            position = bisect_right(TEAM_HOURS_BUCKETS, row["hours"]) - 1
+            if 0 <= position < len(counts):
+                counts[position] += 1
+        return [
+            {"min_hours": low, "max_hours": high, "users": users}
+            for low, high, users in zip(TEAM_HOURS_BUCKETS, TEAM_HOURS_BUCKETS[1:], counts)
+        ]
+
+    def team_calendar(self, start_date, end_date):
+        rows = self._query(
+            "SELECT day, group_concat(user_id) AS user_ids FROM occupancy "
+            "WHERE day BETWEEN ? AND ? GROUP BY day ORDER BY day",
+            (start_date, end_date)
+        )
+        return [{"date": row["day"], "user_ids": sorted(row["user_ids"].split(","))} for row in rows]
+
+    def rebuild_occupancy(self):
+        self._transaction(rebuild_local_occupancy)
+
+    def get_usernames(self, user_ids):
+        user_ids = [int(user_id) for user_id in user_ids]
+        placeholders = ", ".join("?" for _ in user_ids)
+        rows = self._query(f"SELECT id, username FROM users WHERE id IN ({placeholders})", user_ids)
+        return {str(row["id"]): row["username"] for row in rows}
+
+    def find_overlaps(self, user_id, start_date, end_date, limit=1):
+        sql = (
+            "SELECT id AS _id, start_date, end_date FROM leaves "
+            "WHERE user_id = ? AND start_date <= ? AND end_date >= ?"
+        )
+        params = (str(user_id), end_date, start_date)
+        if limit:
+            sql += " LIMIT ?"
+            params += (limit,)
+        return self._query(sql, params)
+
+    def _balance(self, conn, user_id):
+        return conn.execute("SELECT leave_balance FROM settings WHERE user_id = ?", (str(user_id),)).fetchone()[0]
+
+    def book_leave(self, user_id, start_date, end_date, hours):
+        hours = float(hours)
+
+        def book(conn):
+            updated = conn.execute(
+                "UPDATE settings SET leave_balance = leave_balance - ? WHERE user_id = ? AND leave_balance >= ?",
+                (hours, str(user_id), hours)
+            ).rowcount
+            if not updated:
+                return None
+            leave_id = conn.execute(
+                "INSERT INTO leaves (user_id, start_date, end_date, hours, requested_on) VALUES (?, ?, ?, ?, ?)",
+                (str(user_id), start_date, end_date, hours, requested_on_now())
+            ).lastrowid
+            update_local_occupancy(conn, user_id, [(start_date, end_date)], 1)
+            record_local_ledger(conn, user_id, [("booking", -hours, leave_id)])
+            return self._balance(conn, user_id)
+
+        return self._transaction(book)
+
+    def import_leaves(self, user_id, leaves):
+        total_hours = sum(float(leave["hours"]) for leave in leaves)
+
+        def import_all(conn):
+            updated = conn.execute(
+                "UPDATE settings SET leave_balance = leave_balance - ? WHERE user_id = ? AND leave_balance >= ?",
+                (total_hours, str(user_id), total_hours)
+            ).rowcount
+            if not updated:
+                return None
+            requested_on = requested_on_now()
+            # One statement per row for the ids the ledger refers to; still one transaction
+            leave_ids = [
+                conn.execute(
+                    "INSERT INTO leaves (user_id, start_date, end_date, hours, requested_on) VALUES (?, ?, ?, ?, ?)",
+                    (str(user_id), leave["start_date"], leave["end_date"], float(leave["hours"]), requested_on)
+                ).lastrowid
+                for leave in leaves
+            ]
+            update_local_occupancy(conn, user_id, [(leave["start_date"], leave["end_date"]) for leave in leaves], 1)
+            record_local_ledger(
+                conn, user_id,
+                [("booking", -float(leave["hours"]), leave_id) for leave, leave_id in zip(leaves, leave_ids)]
+            )
+            return self._balance(conn, user_id)
+
+        return self._transaction(import_all)
+
+    def cancel_leave(self, user_id, leave_id):
+        def cancel(conn):
+            leave = conn.execute(
+                "SELECT hours, start_date, end_date FROM leaves WHERE id = ? AND user_id = ?",
+                (int(leave_id), str(user_id))
+            ).fetchone()
+            if leave is None:
+                return None
+            conn.execute("DELETE FROM leaves WHERE id = ?", (int(leave_id),))
+            update_local_occupancy(conn, user_id, [(leave['start_date'], leave['end_date'])], -1)
+            conn.execute(
+                "UPDATE settings SET leave_balance = leave_balance + ? WHERE user_id = ?",
+                (leave['hours'], str(user_id))
+            )
+            record_local_ledger(conn, user_id, [("refund", leave['hours'], leave_id)])
+            return self._balance(conn, user_id)
+
+        return self._transaction(cancel)
+
+    def _delete_and_refund(self, user_id, where, params):
+        def delete_and_refund(conn):
+            leaves = conn.execute(f"SELECT id, hours, start_date, end_date FROM leaves WHERE {where}", params).fetchall()
+            total_hours = sum(leave['hours'] for leave in leaves)
+            conn.execute(f"DELETE FROM leaves WHERE {where}", params)
+            update_local_occupancy(conn, user_id, [(leave['start_date'], leave['end_date']) for leave in leaves], -1)
+            conn.execute(
+                "UPDATE settings SET leave_balance = leave_balance + ? WHERE user_id = ?",
+                (total_hours, str(user_id))
+            )
+            record_local_ledger(conn, user_id, [("refund", leave['hours'], leave['id']) for leave in leaves])
+            return self._balance(conn, user_id)
+
+        return self._transaction(delete_and_refund)
+
+    def cancel_leaves(self, user_id, leave_ids):
+        placeholders = ", ".join("?" for _ in leave_ids)
+        return self._delete_and_refund(
+            user_id,
+            f"user_id = ? AND id IN ({placeholders})",
+            (str(user_id), *(int(leave_id) for leave_id in leave_ids))
+        )
+
+    def cancel_all_leaves(self, user_id):
+        return self._delete_and_refund(user_id, "user_id = ?", (str(user_id),))
+
+    def ledger_events(self, user_id, limit=LEDGER_PAGE_SIZE):
+        return self._query(
+            "SELECT seq, at, kind, hours, leave_id FROM ledger WHERE user_id = ? ORDER BY seq DESC LIMIT ?",
+            (str(user_id), limit)
+        )
+
+    def _latest_snapshot(self, conn, user_id, cutoff=None):
+        if cutoff is None:
+            snapshot = conn.execute(
+                "SELECT seq, balance FROM balance_snapshots WHERE user_id = ? ORDER BY seq DESC LIMIT 1",
+                (str(user_id),)
+            ).fetchone()
+        else:
+            snapshot = conn.execute(
+                "SELECT seq, balance FROM balance_snapshots WHERE user_id = ? AND at < ? "
+                "ORDER BY at DESC, seq DESC LIMIT 1",
+                (str(user_id), cutoff.strftime(TIMESTAMP_FORMAT))
+            ).fetchone()
+        return tuple(snapshot) if snapshot else (0, 0.0)
+
+    def _first_ledger_event(self, conn, user_id):
+        return conn.execute("SELECT at FROM ledger WHERE user_id = ? ORDER BY seq LIMIT 1", (str(user_id),)).fetchone()
+
+    def ledger_start(self, user_id):
+        with self._lock:
+            first = self._first_ledger_event(self.conn, user_id)
+        return first[0] if first else None
+
+    def balance_as_of(self, user_id, as_of=None):
+        cutoff = ledger_cutoff(as_of)
+        with self._lock:
+            if cutoff is not None:
+                first = self._first_ledger_event(self.conn, user_id)
+                if first is None or first[0] >= cutoff.strftime(TIMESTAMP_FORMAT):
+                    return None
+            base_seq, balance = self._latest_snapshot(self.conn, user_id, cutoff)
+            sql, params = "SELECT COALESCE(SUM(hours), 0) FROM ledger WHERE user_id = ? AND seq > ?", (str(user_id), base_seq)
+            if cutoff is not None:
+                sql += " AND at < ?"
+                params += (cutoff.strftime(TIMESTAMP_FORMAT),)
+            return balance + self.conn.execute(sql, params).fetchone()[0]
+
+    def rebuild_balance(self, user_id, from_seq=None):
+        def rebuild(conn):
+            if from_seq is not None:
+                conn.execute("DELETE FROM balance_snapshots WHERE user_id = ? AND seq >= ?", (str(user_id), from_seq))
+            base_seq, balance = self._latest_snapshot(conn, user_id)
+            events = conn.execute(
+                "SELECT seq, at, hours FROM ledger WHERE user_id = ? AND seq > ? ORDER BY seq",
+                (str(user_id), base_seq)
+            )
+            balance, snapshots = replay_ledger(base_seq, balance, events)
+            conn.executemany(
+                "INSERT OR REPLACE INTO balance_snapshots (user_id, seq, at, balance) VALUES (?, ?, ?, ?)",
+                [(str(user_id), seq, at, value) for seq, at, value in snapshots]
+            )
+            conn.execute("UPDATE settings SET leave_balance = ? WHERE user_id = ?", (balance, str(user_id)))
+            return balance
+
+        return self._transaction(rebuild)
+
+    def archived_years(self):
+        return [row["year"] for row in self._query("SELECT year FROM archived_years ORDER BY year")]
+
+    def archive_year(self, year, carry_over_limit=None):
+        year = int(year)
+        if year >= date.today().year:
+            raise ValueError(f"{year} is not over yet and cannot be archived")
+        # Marked first: readers union both partitions for the year while leaves move
+        self._transaction(lambda conn: conn.execute("INSERT OR IGNORE INTO archived_years (year) VALUES (?)", (year,)))
+
+        return count_archived(
+            self._archive_user_year(settings["user_id"], year, carry_over_limit)
+            for settings in self._query("SELECT user_id FROM settings")
+        )
+
+    # Moves one user's leaves for the year and writes their summary in one
+    # transaction. Returns (leaves moved, closing balance), or None if already archived.
+    def _archive_user_year(self, user_id, year, carry_over_limit):
+        first_day, last_day = year_range(year)
+
+        def archive(conn):
+            if conn.execute(
+                "SELECT 1 FROM leave_year_summaries WHERE user_id = ? AND year = ?", (user_id, year)
+            ).fetchone():
+                return None
+            closing_balance = self.balance_as_of(user_id, last_day)
+            # Leaves running into the next year stay active for its overlap checks
+            where, params = "user_id = ? AND start_date BETWEEN ? AND ? AND end_date <= ?", (user_id, first_day, last_day, last_day)
+            totals = conn.execute(f"SELECT COALESCE(SUM(hours), 0.0), COUNT(*) FROM leaves WHERE {where}", params).fetchone()
+            conn.execute(f"INSERT INTO leaves_archive SELECT * FROM leaves WHERE {where}", params)
+            conn.execute(f"DELETE FROM leaves WHERE {where}", params)
+
+            carried_over, forfeited = carry_over(closing_balance, self._balance(conn, user_id), carry_over_limit)
+            if forfeited:
+                conn.execute(
+                    "UPDATE settings SET leave_balance = leave_balance - ? WHERE user_id = ?", (forfeited, user_id)
+                )
+                record_local_ledger(conn, user_id, [("adjust", -forfeited, None)])
+            conn.execute(
+                "INSERT INTO leave_year_summaries "
+                "(user_id, year, hours, count, closing_balance, carried_over, forfeited, archived_on) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id, year, totals[0], totals[1], closing_balance, carried_over, forfeited, requested_on_now())
+            )
+            return totals[1], closing_balance
+
+        return self._transaction(archive)
+
+    def year_summaries(self, user_id):
+        return self._query(
+            "SELECT year, hours, count, closing_balance, carried_over, forfeited, archived_on "
+            "FROM leave_year_summaries WHERE user_id = ? ORDER BY year",
+            (str(user_id),)
+        )
+
+# Builds a backend from a config mapping: {"backend": "mongo", "connection_string": ..., <pool settings>}
+# or {"backend": "sqlite", "path": "leave_tracker.db"}; "memory" is SQLite in memory
+def create_storage(config):
+    backend = config.get("backend", "mongo")
+    if backend == "mongo":
+        pool_settings = {key: config[key] for key in DEFAULT_POOL_SETTINGS if key in config}
+        return MongoStorage(
+            config["connection_string"],
+            database=config.get("database", "leave_tracker"),
+            **pool_settings
+        )
+    if backend == "sqlite":
+        return LocalStorage(config.get("path", "leave_tracker.db"))
+    if backend == "memory":
+        return LocalStorage(":memory:")
+    raise ValueError(f"Unknown storage backend: {backend}")
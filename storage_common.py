@@ -0,0 +1,10 @@
+# Parts of the storage interface the app needs before a backend is created.
+# Kept free of pymongo, so the login page can be drawn without loading the
+# database driver; storage.py imports them from here.
+
+# Rows per history page, and the fields the history view displays
+HISTORY_PAGE_SIZE = 25
+HISTORY_FIELDS = ("_id", "start_date", "end_date", "hours", "requested_on")
+
+class UsernameTakenError(Exception):
+    pass
@@ -0,0 +1,109 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# max_workers threads run password hashes; up to max_pending more may wait for
+# one. A submit beyond that waits queue_timeout seconds for room, then fails.
+# Long-running jobs have their own max_jobs threads and max_pending_jobs queue,
+# so they can never take the threads logins hash on.
+DEFAULT_WORKER_SETTINGS = {
+    "max_workers": 4,
+    "max_pending": 32,
+    "queue_timeout": 10.0,
+    "max_jobs": 2,
+    "max_pending_jobs": 8,
+}
+
+class WorkerPoolBusyError(RuntimeError):
+    pass
+
+# A long-running task whose progress the session polls across reruns. The task
+# receives the job as its first argument and calls report() as it goes.
+class Job:
+    def __init__(self, name):
+        self.name = name
+        self.progress = 0.0
+        self.message = ""
+        self.started = time.monotonic()
+        self.future = None
+
+    def report(self, done, total, message=None):
+        self.progress = done / total if total else 1.0
+        self.message = message or f"{done} of {total}"
+
+    @property
+    def done(self):
+        return self.future is not None and self.future.done()
+
+    # Exception raised by the task, or None; only meaningful once done
+    @property
+    def error(self):
+        return self.future.exception() if self.done else None
+
+    @property
+    def result(self):
+        return self.future.result() if self.done and self.future.exception() is None else None
+
+# Bounded thread pool shared by every session in the process for CPU-heavy
+# password hashing or long-running data operations, so they neither run on a
+# session's script thread nor pile up without limit under load
+class WorkerPool:
+    def __init__(self, max_workers=DEFAULT_WORKER_SETTINGS["max_workers"],
+                 max_pending=DEFAULT_WORKER_SETTINGS["max_pending"],
+                 queue_timeout=DEFAULT_WORKER_SETTINGS["queue_timeout"],
+                 thread_name_prefix="leave-worker"):
+        self.max_workers = max_workers
+        self.capacity = max_workers + max_pending
+        self.queue_timeout = queue_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+
+    # Queues fn(*args) and returns its future. With wait=False a full pool
+    # rejects the task at once instead of waiting up to queue_timeout.
+    def submit(self, fn, *args, wait=True):
+        acquired = self._slots.acquire(timeout=self.queue_timeout) if wait else self._slots.acquire(blocking=False)
+        if not acquired:
+            with self._lock:
+                self._rejected += 1
+            raise WorkerPoolBusyError("The server is busy, please try again in a moment.")
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_flight += 1
+        future.add_done_callback(self._task_done)
+        return future
+
+    def _task_done(self, _):
+        with self._lock:
+            self._in_flight -= 1
+            self._completed += 1
+        self._slots.release()
+
+    # Runs fn(*args) on the pool and waits for its result
+    def run(self, fn, *args):
+        return self.submit(fn, *args).result()
+
+    def start_job(self, name, fn, *args, wait=True):
+        job = Job(name)
+        job.future = self.submit(fn, job, *args, wait=wait)
+        return job
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "capacity": self.capacity,
+                "in_flight": self._in_flight,
+                "completed": self._completed,
+                "rejected": self._rejected,
+            }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)